@@ -0,0 +1,112 @@
+import numpy as np
+from models import Account
+
+def address_bytes(address):
+    # convert a "0x" hex address to its 20 raw bytes (None if it is not a valid address)
+    if not address or len(address) != 42:
+        return None
+    try:
+        return bytes.fromhex(address[2:])
+    except ValueError:
+        return None
+
+class AddressIndex():
+    """Process wide index of the active (watched) addresses.
+
+    Loaded once at startup and then kept up to date by the watch/stop handlers
+    so the scanner never has to query the db. The addresses are stored as a
+    sorted array of 20 byte values (about a fifth of the memory of a list of
+    hex strings) and recent changes are kept in small overlay sets until they
+    are merged in.
+    """
+
+    def __init__(self, merge_threshold=10000):
+        self.merge_threshold = merge_threshold
+        self.sorted = np.array([], dtype="S20")
+        self.added = set()
+        self.removed = set()
+
+    def load(self, session):
+        addrs = (address_bytes(address) for address, in session.query(Account.address).filter(Account.active == True).yield_per(10000))
+        self.load_bytes(addr for addr in addrs if addr)
+
+    def load_bytes(self, addrs):
+        self.sorted = np.unique(np.fromiter(addrs, dtype="S20"))
+        self.added = set()
+        self.removed = set()
+
+    def merge(self):
+        arr = self.sorted
+        if self.added:
+            arr = np.unique(np.concatenate([arr, np.array(list(self.added), dtype="S20")]))
+        if self.removed:
+            arr = arr[~np.isin(arr, np.array(list(self.removed), dtype="S20"))]
+        self.sorted = arr
+        self.added = set()
+        self.removed = set()
+
+    def _in_sorted(self, addr):
+        i = np.searchsorted(self.sorted, addr)
+        # numpy strips trailing null bytes from fixed width byte strings
+        return i < len(self.sorted) and self.sorted[i].ljust(20, b"\0") == addr
+
+    def add(self, address):
+        addr = address_bytes(address)
+        if not addr:
+            return
+        self.removed.discard(addr)
+        if not self._in_sorted(addr):
+            self.added.add(addr)
+        if len(self.added) + len(self.removed) > self.merge_threshold:
+            self.merge()
+
+    def remove(self, address):
+        addr = address_bytes(address)
+        if not addr:
+            return
+        self.added.discard(addr)
+        if self._in_sorted(addr):
+            self.removed.add(addr)
+        if len(self.added) + len(self.removed) > self.merge_threshold:
+            self.merge()
+
+    def match(self, addresses):
+        """Return a list of bools, one for each address (or None) given, in a single vectorized lookup."""
+        addrs = [address_bytes(address) or b"" for address in addresses]
+        if not addrs:
+            return []
+        query = np.array(addrs, dtype="S20")
+        found = np.zeros(len(addrs), dtype=bool)
+        if len(self.sorted):
+            idx = np.searchsorted(self.sorted, query)
+            np.minimum(idx, len(self.sorted) - 1, out=idx)
+            found = self.sorted[idx] == query
+        # invalid/missing addresses never match
+        found &= np.array([len(addr) == 20 for addr in addrs])
+        result = found.tolist()
+        if self.added or self.removed:
+            for i, addr in enumerate(addrs):
+                if addr in self.added:
+                    result[i] = True
+                elif addr in self.removed:
+                    result[i] = False
+        return result
+
+    def __contains__(self, address):
+        addr = address_bytes(address)
+        if not addr or addr in self.removed:
+            return False
+        return addr in self.added or self._in_sorted(addr)
+
+    def __len__(self):
+        return len(self.sorted) - len(self.removed) + len(self.added)
+
+    def __iter__(self):
+        for addr in self.sorted:
+            addr = addr.ljust(20, b"\0")
+            if addr not in self.removed:
+                yield "0x" + addr.hex()
+        for addr in self.added:
+            yield "0x" + addr.hex()
+
+active_addresses = AddressIndex()
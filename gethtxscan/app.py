@@ -1,21 +1,46 @@
 #!/usr/bin/env python3
 
+# make socket io cooperative so the block scanner can fetch blocks concurrently
+from gevent import monkey
+monkey.patch_all(thread=False)
+
 import sys
 import os
-import threading
 import time
-from flask import Flask, request, jsonify
+import base64
+import argparse
+import signal
+import functools
+from urllib.parse import urlparse
+import requests
+from flask import Flask, Response, request, jsonify, stream_with_context
 import gevent
+import gevent.lock
 from gevent.pywsgi import WSGIServer
-from database import db_session, init_db
-from models import Account, Block
+from database import db_session, init_db, engine, run_in_threadpool
+from models import Account, AccountTotal, Backfill, Block, Transaction, TxChange, tx_rows_json
+from address_index import active_addresses
+import db_settings
+from bloom import addresses_with_txs
+from change_hub import change_hub
+from response_cache import response_cache
 from config import Cfg
-from eth_blocks import get_pending_txs
+import rpc
+from eth_blocks import get_pending_txs, get_rpc_stats, get_pending_lookup_stats, get_latest_block_num, load_pending_txs, check_network
 from block_check import BlockCheckGreenlet
+from backfill import BackfillGreenlet
+from change_follower import ChangeFollowerGreenlet
 
 cfg = Cfg()
 init_db()
-account_lock = threading.Lock()
+active_addresses.load(db_session)
+addresses_with_txs.load(Account.addresses_with_txs(db_session), cfg.has_txs_bloom_capacity)
+change_hub.start(TxChange.last_seq(db_session))
+load_pending_txs(Transaction.pending_rows(db_session))
+# serializes the db writers (watch/stop, block check and backfill), a gevent lock so waiting for it only blocks the waiting greenlet
+account_lock = gevent.lock.RLock()
+# set in the api worker processes, they only read the db and pass the writes on to the scanner process
+read_only = False
 app = Flask("gethtxscan")
 if not app.debug:
     import logging
@@ -26,6 +51,8 @@ if not app.debug:
     file_handler.setFormatter(formatter)
     app.logger.addHandler(file_handler)
     app.logger.setLevel(logging.INFO)
+    rpc.logger.addHandler(file_handler)
+    rpc.logger.setLevel(logging.INFO)
 
 @app.errorhandler(Exception)
 def exceptions(e):
@@ -51,80 +78,266 @@ def root():
     num_accounts = Account.count(db_session)
     return "last block: %d, %s<br/>number of accounts tracked: %d" % (last_block.num, last_block.hash.hex(), num_accounts)
 
+def writer_endpoint(fn):
+    # endpoints that write to the db (or need the scanner state) are forwarded by the read only workers
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if read_only:
+            r = requests.get(cfg.writer_uri + request.full_path, timeout=30)
+            return Response(r.content, status=r.status_code, content_type=r.headers.get("Content-Type"))
+        return fn(*args, **kwargs)
+    return wrapper
+
 @app.route("/watch_account/<account>")
+@writer_endpoint
 def watch_account(account):
+    from_block = request.args.get("from_block", cfg.startblock, type=int)
     with account_lock:
         acct = Account.from_address(db_session, account.lower())
+        newly_watched = not acct.id or not acct.active
         acct.active = True
         db_session.add(acct)
+        # queue a scan of the blocks we have already passed for txs to the new address, up to the chain head
+        # because the scanner may have fetched blocks past its last commit, matched without the new address
+        last_block = Block.last_block(db_session)
+        to_block = max(last_block.num if last_block else -1, get_latest_block_num())
+        if newly_watched and cfg.backfill_on_watch and to_block >= 0 and from_block <= to_block:
+            Backfill.queue(db_session, acct.address, from_block, to_block)
+        db_settings.bump_accounts_version(db_session)
         db_session.commit()
+        active_addresses.add(acct.address)
+        get_pending_txs().watch(acct.address)
+        response_cache.invalidate("active_accounts", db_settings.get_accounts_version(db_session))
     return jsonify(acct.to_json())
 
 @app.route("/stop_account/<account>")
+@writer_endpoint
 def stop_account(account):
     with account_lock:
         acct = Account.from_address(db_session, account.lower())
         acct.active = False
         db_session.add(acct)
+        db_settings.bump_accounts_version(db_session)
         db_session.commit()
+        active_addresses.remove(acct.address)
+        get_pending_txs().unwatch(acct.address)
+        response_cache.invalidate("active_accounts", db_settings.get_accounts_version(db_session))
     return jsonify(acct.to_json())
 
+def account_etag(address):
+    return response_cache.account_etag(address, lambda: TxChange.last_account_seq(db_session, address))
+
+def cached_response(key, etag, build, store=True):
+    # 304 if the client has the current version of the response, else the cached or newly built response
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cached = response_cache.get(key, request.full_path)
+        if cached:
+            response = Response(cached[0], mimetype=cached[1], headers=cached[2])
+        else:
+            response = build()
+            if store:
+                response_cache.put(key, request.full_path, (response.get_data(), response.mimetype, [header for header in response.headers if header[0].startswith("X-")]))
+    response.set_etag(etag)
+    return response
+
 @app.route("/list_transactions/<account>")
 def list_transactions(account):
-    acct = Account.from_address(db_session, account.lower())
-    txs = []
-    for tx in acct.transactions:
-        block = Block.tx_block(db_session, tx.block_id)
-        txs.append(tx.to_json(block))
-    return jsonify(txs)
+    address = account.lower()
+    try:
+        since_block = request.args.get("since_block", type=int)
+        limit = request.args.get("limit", type=int)
+        after_id = None
+        if "cursor" in request.args:
+            after_id = int(base64.urlsafe_b64decode(request.args["cursor"]).decode())
+    except ValueError:
+        return "Invalid cursor", 400
+    if limit is not None and limit < 1:
+        return "Invalid limit", 400
+    # full lists are streamed so only pages are kept in the cache
+    return cached_response(address, account_etag(address), lambda: build_list_transactions(address, since_block, limit, after_id), store=limit is not None)
+
+def build_list_transactions(address, since_block, limit, after_id):
+    acct = Account.from_address(db_session, address)
+    if not acct.id:
+        return jsonify([])
+    rows = Transaction.account_rows(db_session, acct.id, since_block, after_id)
+    headers = {}
+    if limit is not None:
+        # fetch one extra row so we know if there is another page
+        rows = rows.limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = base64.urlsafe_b64encode(str(rows[-1].id).encode()).decode()
+    else:
+        rows = rows.yield_per(1000)
+    return Response(stream_with_context(tx_rows_json(rows)), mimetype="application/json", headers=headers)
+
+@app.route("/changes")
+def changes():
+    # every tx added, confirmed, dropped or reorged (for all accounts) after the change seq `since`
+    since = request.args.get("since", 0, type=int)
+    limit = min(request.args.get("limit", 1000, type=int), 10000)
+    if limit < 1:
+        return "Invalid limit", 400
+    rows = TxChange.since(db_session, since, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    last_seq = rows[-1].seq if rows else max(since, 0)
+    return jsonify({"changes": [row.to_json() for row in rows], "last_seq": last_seq, "more": more})
+
+@app.route("/stream")
+def stream():
+    # server sent events of the tx changes, resumable from a change seq (since or Last-Event-ID)
+    try:
+        since = request.args.get("since", type=int)
+        if "Last-Event-ID" in request.headers:
+            since = int(request.headers["Last-Event-ID"])
+    except ValueError:
+        return "Invalid Last-Event-ID", 400
+    if since is None:
+        since = change_hub.last_seq
+    addresses = set(address.lower() for address in request.args.get("addresses", "").split(",") if address)
+    def generate():
+        for events in change_hub.subscribe(db_session, since):
+            if not events:
+                yield ": keepalive\n\n"
+            for seq, to, data in events:
+                if not addresses or to in addresses:
+                    yield "id: %d\nevent: tx\ndata: %s\n\n" % (seq, data)
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.route("/incomming_value/<account>")
 def incomming_value(account):
-    acct = Account.from_address(db_session, account.lower())
-    value = 0
-    for tx in acct.transactions:
-        value += tx.value
-    return jsonify(str(value))
+    address = account.lower()
+    def build():
+        acct = Account.from_address(db_session, address)
+        value = 0
+        total = AccountTotal.get(db_session, acct.id)
+        if total:
+            value = total.confirmed + total.pending
+        return jsonify(str(value))
+    return cached_response(address, account_etag(address), build)
 
 @app.route("/has_transactions", methods=("POST",))
 def has_transactions():
     start = time.time()
-    addresses = request.form["addresses"]
-    if addresses:
-        addresses = addresses.split(",")
+    # addresses can be a json list (or {"addresses": [..]}), newline delimited text or a comma joined form field
+    if request.is_json:
+        addresses = request.get_json()
+        if isinstance(addresses, dict):
+            addresses = addresses.get("addresses", [])
+    elif request.mimetype == "text/plain":
+        addresses = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
     else:
-        addresses = []
-    addrs_with_txs = Account.has_txs(db_session, addresses)
+        addresses = request.form["addresses"]
+        if addresses:
+            addresses = addresses.split(",")
+        else:
+            addresses = []
+    # large checks take a while so they are run off the hub
+    addrs_with_txs = run_in_threadpool(Account.has_txs, addresses, addresses_with_txs)
     app.logger.info("*has_transactions* check took %f seconds (%d checked, %d with tx)" % (time.time() - start, len(addresses), len(addrs_with_txs)))
     return jsonify(addrs_with_txs)
 
 @app.route("/last_blocknum")
 def last_blocknum():
-    last_block = Block.last_block(db_session)
-    if last_block:
-        return jsonify({"last_blocknum": last_block.num})
-    return jsonify({"last_blocknum": 0})
+    def build():
+        last_block = Block.last_block(db_session)
+        if last_block:
+            return jsonify({"last_blocknum": last_block.num})
+        return jsonify({"last_blocknum": 0})
+    return cached_response("last_blocknum", response_cache.global_etag("last_blocknum", lambda: db_settings.get_current_block_number(db_session, -1)), build)
 
 @app.route("/num_pending_txs")
+@writer_endpoint
 def num_pending_txs():
     return jsonify({"num_pending_txs": len(get_pending_txs())})
 
+@app.route("/backfill_status")
+def backfill_status():
+    pending = Backfill.pending(db_session)
+    recent = Backfill.recent(db_session, request.args.get("recent", 10, type=int))
+    return jsonify({"pending": [backfill.to_json() for backfill in pending], "recent": [backfill.to_json() for backfill in recent]})
+
+@app.route("/rpc_stats")
+@writer_endpoint
+def rpc_stats():
+    return jsonify(get_rpc_stats())
+
+@app.route("/pending_lookup_stats")
+@writer_endpoint
+def pending_lookup_stats():
+    return jsonify(get_pending_lookup_stats())
+
 @app.route("/active_accounts")
 def active_accounts():
-    n = Account.count_active(db_session)
-    return jsonify({"active_accounts": n})
+    def build():
+        return jsonify({"active_accounts": Account.count_active(db_session)})
+    return cached_response("active_accounts", response_cache.global_etag("active_accounts", lambda: db_settings.get_accounts_version(db_session)), build)
 
 @app.route("/all_active_addresses")
 def all_active_addresses():
     addresses = Account.all_active_addresses(db_session)
     return jsonify({"active_addresses": addresses})
 
-if __name__ == '__main__':
-    http_server = WSGIServer(('', 5001), app)
+def run_scanner(http_address):
+    # the scanner and backfill are the only db writers
+    http_server = WSGIServer(http_address, app)
     srv_greenlet = gevent.spawn(http_server.start)
     block_check = BlockCheckGreenlet(app.logger, account_lock)
     block_check.start()
+    backfill = BackfillGreenlet(app.logger, account_lock)
+    backfill.start()
+    try:
+        gevent.joinall([srv_greenlet, block_check, backfill])
+    except KeyboardInterrupt:
+        print("Exiting")
+
+def run_workers(count, port):
+    global read_only
+    read_only = True
+    # one listening socket shared by the forked workers, the kernel spreads the connections between them
+    http_server = WSGIServer(("", port), app)
+    http_server.init_socket()
+    # the workers must not share the sqlite connections of this process
+    db_session.remove()
+    engine.dispose()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            follower = ChangeFollowerGreenlet(app.logger, cfg.worker_poll_interval)
+            follower.start()
+            http_server.serve_forever()
+            os._exit(0)
+        pids.append(pid)
+    # stop the workers with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        gevent.joinall([srv_greenlet, block_check])
+        for pid in pids:
+            os.waitpid(pid, 0)
     except KeyboardInterrupt:
         print("Exiting")
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="gethtxscan api and block scanner")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--scanner", action="store_true", help="run only the scanner (the only db writer) with the api on the local writer_uri port")
+    group.add_argument("--workers", type=int, nargs="?", const=cfg.api_workers, help="run only the api in read only worker processes (default api_workers), writes are passed on to writer_uri")
+    parser.add_argument("--port", type=int, default=5001)
+    args = parser.parse_args()
+    check_network()
+    if args.scanner:
+        run_scanner(("127.0.0.1", urlparse(cfg.writer_uri).port))
+    elif args.workers:
+        run_workers(args.workers, args.port)
+    else:
+        run_scanner(("", args.port))
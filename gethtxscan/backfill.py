@@ -0,0 +1,117 @@
+import time
+import gevent
+import gevent.pool
+from gevent import Greenlet
+from database import Session
+from models import Account, Block, Backfill
+from address_index import AddressIndex, address_bytes
+from config import Cfg
+from rpc import BatchRpc
+from eth_blocks import get_blocks_hash_and_txs
+from change_hub import change_hub
+import db_settings
+
+cfg = Cfg()
+
+class BackfillGreenlet(Greenlet):
+    """Scans historical blocks for the txs of newly watched addresses.
+
+    All the pending backfills are served by one shared pass over the chain,
+    the range is split into chunks that are fetched by a small worker pool.
+    It has its own db session and rpc connection so the tip following
+    BlockCheckGreenlet is not held up while a backfill is running.
+    """
+
+    def __init__(self, logger, account_lock):
+        Greenlet.__init__(self)
+        self.logger = logger
+        self.account_lock = account_lock
+        self.delay = 5
+        self.keep_running = True
+        self.session = Session()
+        self.rpc = BatchRpc(cfg.geth_uri, timeout=60)
+        self.pool = gevent.pool.Pool(cfg.backfill_workers)
+
+    def stop_processing(self):
+        self.keep_running = False
+
+    def _run(self):
+        while self.keep_running:
+            gevent.sleep(self.delay)
+            self.backfill_pass()
+
+    def scan_chunk(self, block_nums, addresses):
+        return block_nums, get_blocks_hash_and_txs(block_nums, addresses, self.rpc)
+
+    def backfill_pass(self):
+        backfills = Backfill.pending(self.session)
+        if not backfills:
+            return
+        # block range of each address (an address can be queued more than once)
+        ranges = {}
+        for backfill in backfills:
+            start, end = ranges.get(backfill.address, (backfill.next_block, backfill.to_block))
+            ranges[backfill.address] = (min(start, backfill.next_block), max(end, backfill.to_block))
+        addresses = AddressIndex()
+        addresses.load_bytes(addr for addr in (address_bytes(address) for address in ranges) if addr)
+        first_block = min(start for start, _ in ranges.values())
+        # blocks above the scan cursor are left until the scanner has committed them, so all of our block
+        # rows are covered by its reorg handling (and Block.last_block stays the last scanned block)
+        last_block = min(max(end for _, end in ranges.values()), self.scanned_block())
+        if first_block > last_block:
+            return
+        self.logger.info("backfill pass of blocks %d-%d for %d addresses" % (first_block, last_block, len(ranges)))
+
+        size = cfg.backfill_chunk_size
+        chunk_starts = range(first_block, last_block + 1, size)
+        block_chunks = (list(range(start, min(start + size, last_block + 1))) for start in chunk_starts)
+        scanned = set()
+        next_block = first_block
+        start = time.time()
+        for block_nums, results in self.pool.imap_unordered(lambda nums: self.scan_chunk(nums, addresses), block_chunks, maxsize=cfg.backfill_workers * 2):
+            if not self.keep_running:
+                self.pool.kill()
+                break
+            # the writes of a chunk are committed before the next yield, the lock waits out the other writers
+            with self.account_lock:
+                if block_nums[-1] > self.scanned_block():
+                    # the scanner rolled back a reorg below this chunk since we fetched it, it is scanned again next pass
+                    continue
+                for block_num, (block_hash, parent_hash, txs, tx_count) in zip(block_nums, results):
+                    # only keep the txs that are inside the requested range of their address
+                    txs = {address: address_txs for address, address_txs in txs.items() if ranges[address][0] <= block_num <= ranges[address][1]}
+                    if txs:
+                        self.add_block_txs(block_num, block_hash, parent_hash, txs)
+                # progress is only recorded for the contiguous range of scanned chunks
+                scanned.add(block_nums[0])
+                while next_block in scanned:
+                    next_block += size
+                for backfill in backfills:
+                    backfill.next_block = max(backfill.next_block, min(next_block, last_block + 1, backfill.to_block + 1))
+                self.session.commit()
+            change_hub.refresh(self.session)
+            self.logger.info("backfill scanned blocks %d-%d (%d/%d blocks done, %f seconds)" % (block_nums[0], block_nums[-1], min(next_block, last_block + 1) - first_block, last_block + 1 - first_block, time.time() - start))
+            start = time.time()
+
+    def scanned_block(self):
+        return db_settings.get_current_block_number(self.session, -1)
+
+    def add_block_txs(self, block_num, block_hash, parent_hash, txs):
+        block = Block.from_hash(self.session, block_hash)
+        if block and block.reorged:
+            self.logger.error("backfill block %d hash %s has been reorged" % (block_num, block_hash.hex()))
+            return
+        if not block:
+            other = Block.from_number(self.session, block_num)
+            if other:
+                # the tip follower has a different block at this height, leave it to the reorg handling
+                self.logger.error("backfill block %d hash %s does not match stored block %s" % (block_num, block_hash.hex(), other.hash.hex()))
+                return
+            block = Block(block_num, block_hash, parent_hash)
+            self.session.add(block)
+            self.session.flush()
+        for key in txs.keys():
+            self.logger.info("backfill adding txs for " + key)
+            for tx in txs[key]:
+                self.logger.info(" - %s, %s" % (tx["hash"].hex(), tx["value"]))
+        Account.add_txs(self.session, block.id, txs)
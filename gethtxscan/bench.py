@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the gethtxscan db paths, each one runs against a scratch sqlite db."""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import random
+import hashlib
+import json
+import base64
+import struct
+import logging
+import queue
+import tracemalloc
+import itertools
+import socket
+import subprocess
+import threading
+import http.client
+import multiprocessing
+import gevent
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from database import Base, apply_storage_profile
+from models import Account, Transaction, Block, set_compact_storage, tx_row_json, tx_rows_json
+import migrations
+from manage import vacuum
+from bloom import AddressTxFilter
+from address_index import AddressIndex, address_bytes
+from pending_pool import PendingPool
+
+def scratch_session(dir_path, profile=None):
+    engine = create_engine("sqlite:///%s/bench.db" % dir_path)
+    if profile:
+        apply_storage_profile(engine, *profile)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+def timeit(fn, n):
+    start = time.time()
+    for _ in range(n):
+        fn()
+    return (time.time() - start) / n
+
+def measure(build):
+    # (object, bytes allocated while building it)
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+def random_address():
+    return "0x" + os.urandom(20).hex()
+
+def random_tx(to):
+    return {"hash": os.urandom(32), "from": random_address(), "to": to, "value": int.from_bytes(os.urandom(10), "big")}
+
+def create_accounts(session, n):
+    addresses = [random_address() for _ in range(n)]
+    for address in addresses:
+        session.add(Account(address))
+    session.commit()
+    return addresses
+
+def add_txs_orm(session, address, block_id, txs):
+    # the previous implementation of Account.add_txs (one select per tx then an orm add)
+    acct = Account.from_address(session, address)
+    for tx in txs:
+        tx_ = Transaction.from_txid(session, tx["hash"])
+        if tx_:
+            tx_.account_id = acct.id
+            tx_.block_id = block_id
+            tx_.from_ = tx["from"]
+            tx_.to = tx["to"]
+            tx_.value = tx["value"]
+        else:
+            tx_ = Transaction(acct.id, block_id, tx["hash"], tx["from"], tx["to"], tx["value"])
+        session.add(tx_)
+
+def bench_address_index(args):
+    """memory and block matching rate of the compact AddressIndex vs the old list and a plain set of the active addresses"""
+    for n in args.sizes:
+        hex_addrs = [random_address() for _ in range(n)]
+        # one block worth of 'to' addresses, a few of which are watched
+        tos = [random_address() for _ in range(args.txs_per_block - 5)] + hex_addrs[:5]
+        lst, lst_size = measure(lambda: list(hex_addrs))
+        st, st_size = measure(lambda: set(hex_addrs))
+        def build_index():
+            index = AddressIndex()
+            index.load_bytes(address_bytes(address) for address in hex_addrs)
+            return index
+        index, index_size = measure(build_index)
+        assert sum(index.match(tos)) == 5
+        # the strings themselves are shared by the list/set so count them in too
+        strs_size = sum(sys.getsizeof(address) for address in hex_addrs)
+        print("%d addresses" % n)
+        print("  memory: list %.1f MB, set %.1f MB, index %.1f MB" % ((lst_size + strs_size) / 1e6, (st_size + strs_size) / 1e6, index_size / 1e6))
+        list_blocks = max(1, 1000000 // n)
+        print("  lookups/sec: list %d, set %d, index %d" % (
+            args.txs_per_block / timeit(lambda: [to in lst for to in tos], list_blocks),
+            args.txs_per_block / timeit(lambda: [to in st for to in tos], args.blocks),
+            args.txs_per_block / timeit(lambda: index.match(tos), args.blocks)))
+
+def bench_add_txs(args):
+    """rows/sec of Account.add_txs vs the old orm loop, for new rows and for rewriting the same rows"""
+    for name in ("orm", "bulk"):
+        with tempfile.TemporaryDirectory() as dir_path:
+            session = scratch_session(dir_path)
+            addresses = create_accounts(session, args.accounts)
+            batches = []
+            for _ in range(args.batches):
+                txs = {}
+                for _ in range(args.batch_size):
+                    to = addresses[len(txs) % len(addresses)]
+                    txs.setdefault(to, []).append(random_tx(to))
+                batches.append(txs)
+            rows = args.batches * args.batch_size
+            for run in ("insert", "rewrite"):
+                start = time.time()
+                for txs in batches:
+                    if name == "orm":
+                        for address, address_txs in txs.items():
+                            add_txs_orm(session, address, None, address_txs)
+                    else:
+                        Account.add_txs(session, None, txs)
+                    session.commit()
+                elapsed = time.time() - start
+                print("%-4s %-7s %d rows in %f seconds (%d rows/sec)" % (name, run, rows, elapsed, rows / elapsed))
+            session.close()
+
+def fill_db(session, accounts, txs, txs_per_block):
+    # bulk load a scratch db with raw inserts, every account gets an equal share of the txs
+    addresses = ["0x%040x" % i for i in range(accounts)]
+    session.execute(text("INSERT INTO accounts (date, address, active) VALUES (:date, :address, 1)"), [{"date": time.time(), "address": address} for address in addresses])
+    blocks = txs // txs_per_block + 1
+    session.execute(text("INSERT INTO blocks (id, date, num, hash, reorged) VALUES (:id, :date, :num, :hash, 0)"), [{"id": i + 1, "date": time.time(), "num": i, "hash": os.urandom(32)} for i in range(blocks)])
+    batch = []
+    for i in range(txs):
+        batch.append({"account_id": i % accounts + 1, "block_id": i // txs_per_block + 1, "txid": os.urandom(32), "from_": addresses[0], "to": addresses[i % accounts], "value": str(random.randrange(10**15, 10**21)), "state": "confirmed"})
+        if len(batch) == 100000:
+            session.execute(text('INSERT INTO transactions (account_id, block_id, txid, from_, "to", value, state) VALUES (:account_id, :block_id, :txid, :from_, :to, :value, :state)'), batch)
+            batch = []
+    if batch:
+        session.execute(text('INSERT INTO transactions (account_id, block_id, txid, from_, "to", value, state) VALUES (:account_id, :block_id, :txid, :from_, :to, :value, :state)'), batch)
+    session.commit()
+    return addresses, blocks
+
+def bench_indexes(args):
+    """hot query latency and write rate before and after the indexes/storage profile migration"""
+    with tempfile.TemporaryDirectory() as dir_path:
+        session = scratch_session(dir_path)
+        for index in ("ix_transactions_account_id", "ix_transactions_block_id", "ix_blocks_num", "ix_blocks_reorged_id"):
+            session.execute(text("DROP INDEX %s" % index))
+        start = time.time()
+        addresses, blocks = fill_db(session, args.accounts, args.txs, args.txs_per_block)
+        print("filled db with %d accounts, %d blocks, %d txs in %f seconds" % (args.accounts, blocks, args.txs, time.time() - start))
+        queries = [
+            ("Block.last_block", lambda: Block.last_block(session)),
+            ("Block.from_number", lambda: Block.from_number(session, random.randrange(blocks))),
+            ("Account.count_txs", lambda: Account.count_txs(session, random.choice(addresses))),
+            ("Account.has_txs (100 addrs)", lambda: Account.has_txs(session, random.sample(addresses, 100))),
+            ("Transaction.account_rows", lambda: Transaction.account_rows(session, random.randrange(args.accounts) + 1).all()),
+        ]
+        def add_txs():
+            to = random.choice(addresses)
+            Account.add_txs(session, None, {to: [random_tx(to)]})
+            session.commit()
+        results = {}
+        for stage in ("before", "after"):
+            if stage == "after":
+                start = time.time()
+                migrations.create_indexes(session)
+                session.commit()
+                print("created indexes in %f seconds" % (time.time() - start))
+                session.close()
+                session = scratch_session(dir_path, ("wal", "normal", -65536, 268435456))
+            for name, fn in queries:
+                results.setdefault(name, []).append(timeit(fn, args.iterations) * 1000)
+            results.setdefault("add_txs + commit", []).append(timeit(add_txs, args.iterations) * 1000)
+        for name, (before, after) in results.items():
+            print("%-30s before %10.3f ms, after %8.3f ms" % (name, before, after))
+        session.close()
+
+def bench_storage(args):
+    """db size and lookup latency in the text and compact storage modes"""
+    with tempfile.TemporaryDirectory() as dir_path:
+        session = scratch_session(dir_path)
+        addresses, blocks = fill_db(session, args.accounts, args.txs, args.txs_per_block)
+        txids = [txid for txid, in session.query(Transaction.txid).filter(Transaction.id % 1000 == 0)]
+        queries = [
+            ("Transaction.from_txid", lambda: Transaction.from_txid(session, random.choice(txids))),
+            ("Account.from_address", lambda: Account.from_address(session, random.choice(addresses))),
+            ("Account.count_txs", lambda: Account.count_txs(session, random.choice(addresses))),
+            ("Transaction.account_rows", lambda: Transaction.account_rows(session, random.randrange(args.accounts) + 1).all()),
+        ]
+        results = {}
+        for mode in ("text", "compact"):
+            if mode == "compact":
+                migrations.convert_storage(session, True)
+                set_compact_storage(True)
+            session.close()
+            results.setdefault("db size (MB)", []).append(vacuum(session.bind) / 1e6)
+            for name, fn in queries:
+                results.setdefault(name + " (ms)", []).append(timeit(fn, args.iterations) * 1000)
+        set_compact_storage(False)
+        for name, (text_mode, compact_mode) in results.items():
+            print("%-30s text %10.3f, compact %10.3f" % (name, text_mode, compact_mode))
+        session.close()
+
+def percentiles(fn, n):
+    times = []
+    for _ in range(n):
+        start = time.time()
+        fn()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.99))]
+
+def has_txs_in(session, addresses):
+    # the previous implementation of Account.has_txs (every address bound in one IN clause)
+    q = session.query(Account, Account.transactions.any()).filter(Account.address.in_(addresses))
+    return [acct.address for acct, has_txs in q.all() if has_txs]
+
+def bench_has_txs(args):
+    """p50/p99 latency of Account.has_txs for 1k, 10k and 100k addresses (mostly without txs)"""
+    with tempfile.TemporaryDirectory() as dir_path:
+        session = scratch_session(dir_path)
+        addresses, blocks = fill_db(session, args.accounts, args.txs, args.txs_per_block)
+        tx_filter = AddressTxFilter()
+        tx_filter.load(Account.addresses_with_txs(session), args.accounts)
+        for n in (1000, 10000, 100000):
+            # half known accounts, half addresses we have never seen
+            check = random.sample(addresses, n // 2) + [random_address() for _ in range(n - n // 2)]
+            expected = sorted(Account.has_txs(session, check))
+            assert sorted(Account.has_txs(session, check, tx_filter)) == expected
+            iterations = max(5, args.iterations * 1000 // n)
+            for name, fn in (("in clause", lambda: has_txs_in(session, check)),
+                    ("temp table/chunks", lambda: Account.has_txs(session, check)),
+                    ("bloom + temp table", lambda: Account.has_txs(session, check, tx_filter))):
+                try:
+                    p50, p99 = percentiles(fn, iterations)
+                    print("%6d addresses (%d with txs) %-20s p50 %9.3f ms, p99 %9.3f ms" % (n, len(expected), name, p50, p99))
+                except Exception as e:
+                    print("%6d addresses (%d with txs) %-20s failed: %s" % (n, len(expected), name, str(e).splitlines()[0]))
+                session.rollback()
+        session.close()
+
+def scan_flat(pending_txs, addresses, max_age, now):
+    # the previous eth_blocks.scan_pending_txs, one pass over the whole flat dict of pending txs
+    txs = {}
+    remove = []
+    for key, (timestamp, tx) in pending_txs.items():
+        to = tx["to"]
+        if to in addresses:
+            txs.setdefault(to, []).append(tx)
+        if now - timestamp > max_age:
+            remove.append(key)
+    for key in remove:
+        del pending_txs[key]
+    return txs
+
+def bench_pending_pool(args):
+    """memory, build time and scan (match + expire) time of the PendingPool vs the flat dict it replaces"""
+    n = args.txs
+    max_age = 60 * 60 * 5
+    now = time.time()
+    watched = set(random_address() for _ in range(args.watched))
+    recipients = list(watched)[:100] + [random_address() for _ in range(50000)]
+    # seen over the last 5 hours, so a few expire on each scan
+    entries = []
+    for i in range(n):
+        txid = os.urandom(32)
+        entries.append((txid, now - max_age + i * max_age / n, {"hash": txid, "from": random_address(), "to": recipients[i % len(recipients)], "value": i}))
+    def build_flat():
+        return {txid: (timestamp, tx) for txid, timestamp, tx in entries}
+    def build_pool():
+        pool = PendingPool(n, lambda to: to in watched)
+        for txid, timestamp, tx in entries:
+            pool.add(txid, timestamp, tx)
+        return pool
+    flat, flat_size = measure(build_flat)
+    pool, pool_size = measure(build_pool)
+    print("%d pending txs, %d watched addresses" % (n, len(watched)))
+    print("  memory (excluding the tx dicts): flat dict %.1f MB, pool %.1f MB" % (flat_size / 1e6, pool_size / 1e6))
+    print("  build: flat dict %.1f ms, pool %.1f ms" % (timeit(build_flat, 3) * 1000, timeit(build_pool, 3) * 1000))
+    # the flat scan matches before it expires so compare against a second pass
+    expired = dict(flat)
+    scan_flat(expired, watched, max_age, now + 60)
+    expected = scan_flat(expired, watched, max_age, now + 60)
+    pool.expire(max_age, now + 60)
+    assert {to: len(txs) for to, txs in pool.matches().items()} == {to: len(txs) for to, txs in expected.items()}
+    print("  scan (match + expire): flat dict %.3f ms, pool %.3f ms" % (
+        timeit(lambda: scan_flat(flat, watched, max_age, now + 60), args.iterations) * 1000,
+        timeit(lambda: (pool.expire(max_age, now + 60), pool.matches()), args.iterations) * 1000))
+    full = PendingPool(n // 2, lambda to: to in watched)
+    start = time.time()
+    for txid, timestamp, tx in entries:
+        full.add(txid, timestamp, tx)
+    print("  add with eviction at a %d cap: %.0f txs/sec (%d evicted)" % (n // 2, n / (time.time() - start), full.evicted))
+
+def bench_tx_json(args):
+    """rows/second of the /list_transactions json for one account: a schema per orm row, a dict per row tuple and the bulk serializer"""
+    with tempfile.TemporaryDirectory() as dir_path:
+        session = scratch_session(dir_path)
+        addresses, blocks = fill_db(session, 1, args.txs, args.txs_per_block)
+        # leave some txs pending
+        session.execute(text("UPDATE transactions SET block_id = NULL, state = 'pending' WHERE id % 10 = 0"))
+        session.commit()
+        acct = Account.from_address(session, addresses[0])
+        def schema_per_row():
+            # the original Transaction.to_json path, an orm object (and its block) per row
+            # (its pre_dump hexes the txid in place so the objects must not be reused)
+            session.expunge_all()
+            txs = session.query(Transaction, Block).outerjoin(Block, Transaction.block_id == Block.id).filter(Transaction.account_id == acct.id).order_by(Transaction.id)
+            return "[" + ",".join(json.dumps(tx.to_json(block), sort_keys=True) for tx, block in txs) + "]\n"
+        def dict_per_row():
+            rows = Transaction.account_rows(session, acct.id).yield_per(1000)
+            return "[" + ",".join(json.dumps(tx_row_json(row), sort_keys=True) for row in rows) + "]\n"
+        def bulk():
+            return "".join(tx_rows_json(Transaction.account_rows(session, acct.id).yield_per(1000)))
+        expected = dict_per_row()
+        assert bulk() == expected
+        assert json.loads(schema_per_row()) == json.loads(expected)
+        for name, fn in (("schema per orm row", schema_per_row), ("dict per row tuple", dict_per_row), ("bulk serializer", bulk)):
+            seconds = timeit(fn, args.iterations)
+            print("%-20s %10.0f rows/second" % (name, args.txs / seconds))
+        session.close()
+
+def http_load(port, paths, seconds, connections):
+    # one client process, keep alive connections in threads, returns the number of ok responses
+    deadline = time.time() + seconds
+    counts = []
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        count = 0
+        while time.time() < deadline:
+            conn.request("GET", random.choice(paths))
+            response = conn.getresponse()
+            response.read()
+            count += response.status == 200
+        counts.append(count)
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception("api did not start on port %d" % port)
+
+def bench_api_load(args):
+    """requests/second of the read endpoints served by "app.py --workers N" (against the configured db, run the scanner to fill it)"""
+    from database import db_session
+    addresses = list(itertools.islice(Account.addresses_with_txs(db_session), args.accounts)) or [random_address()]
+    db_session.remove()
+    paths = ["/last_blocknum"]
+    for address in addresses:
+        paths += ["/list_transactions/%s?limit=50" % address, "/incomming_value/%s" % address]
+    for workers in args.workers:
+        api = subprocess.Popen([sys.executable, "app.py", "--workers", str(workers), "--port", str(args.port)],
+                cwd=os.path.dirname(os.path.realpath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            with multiprocessing.Pool(args.clients) as pool:
+                counts = pool.starmap(http_load, [(args.port, paths, args.seconds, args.connections)] * args.clients)
+            print("%2d workers: %9.1f requests/second (%d clients x %d connections, %d accounts)" % (workers, sum(counts) / args.seconds, args.clients, args.connections, len(addresses)))
+        finally:
+            api.terminate()
+            api.wait()
+
+def use_scratch_app_db(dir_path):
+    # point the app's engine and sessions at a scratch db with the same engine settings as the configured one
+    import database
+    from config import Cfg
+    cfg = Cfg()
+    engine = create_engine("sqlite:///%s/bench.db" % dir_path, poolclass=database.QueuePool, pool_size=cfg.db_pool_size,
+            max_overflow=cfg.db_pool_overflow, connect_args={"check_same_thread": False})
+    apply_storage_profile(engine, cfg.sqlite_journal_mode, cfg.sqlite_synchronous, cfg.sqlite_cache_size, cfg.sqlite_mmap_size)
+    database.engine = engine
+    database.Session.configure(bind=engine)
+    database.db_session.remove()
+
+class FakeGethServer():
+    """Local geth stand-in for the subscription transports, websocket (kind "ws") or ipc (a unix socket path).
+
+    Each connection answers the two eth_subscribe calls, pushes one new head and
+    three pending txids, then the first connection is dropped so the client has
+    to fall back and reconnect. Ipc events are written two objects at a time
+    and split mid object to exercise the stream decoding.
+    """
+
+    def __init__(self, kind, address, txids):
+        from gevent.server import StreamServer
+        self.kind = kind
+        self.txids = txids
+        self.connections = 0
+        self.server = StreamServer(address, self.handle)
+        self.server.start()
+
+    def read_exact(self, f, n):
+        data = f.read(n)
+        if len(data) < n:
+            raise ConnectionError("closed")
+        return data
+
+    def recv(self, sock, f):
+        if self.kind == "ipc":
+            # the client can write both calls at once
+            while True:
+                self.buf = self.buf.lstrip()
+                try:
+                    msg, end = json.JSONDecoder().raw_decode(self.buf)
+                    self.buf = self.buf[end:]
+                    return msg
+                except ValueError:
+                    data = sock.recv(65536)
+                    if not data:
+                        raise ConnectionError("closed")
+                    self.buf += data.decode()
+        # a masked text frame from the client
+        header = self.read_exact(f, 2)
+        length = header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack(">H", self.read_exact(f, 2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.read_exact(f, 8))[0]
+        mask = self.read_exact(f, 4)
+        return json.loads(bytes(b ^ mask[i % 4] for i, b in enumerate(self.read_exact(f, length))).decode())
+
+    def send(self, sock, msgs):
+        data = "".join(json.dumps(msg) for msg in msgs).encode()
+        if self.kind == "ipc":
+            sock.sendall(data[:len(data) // 2 + 7])
+            gevent.sleep(0.05)
+            sock.sendall(data[len(data) // 2 + 7:])
+            return
+        for msg in msgs:
+            data = json.dumps(msg).encode()
+            header = bytes([0x81, len(data)]) if len(data) < 126 else bytes([0x81, 126]) + struct.pack(">H", len(data))
+            sock.sendall(header + data)
+
+    def handle(self, sock, address):
+        self.connections += 1
+        connection = self.connections
+        self.buf = ""
+        f = sock.makefile("rb")
+        if self.kind == "ws":
+            lines = []
+            while True:
+                line = f.readline().decode().strip()
+                if not line:
+                    break
+                lines.append(line)
+            key = [line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("sec-websocket-key")][0]
+            accept = base64.b64encode(hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest()).decode()
+            sock.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+        try:
+            for _ in range(2):
+                msg = self.recv(sock, f)
+                self.send(sock, [{"jsonrpc": "2.0", "id": msg["id"], "result": "0x" + msg["params"][0]}])
+            events = [("newHeads", {"number": "0x1"})] + [("newPendingTransactions", txid) for txid in self.txids]
+            events = [{"jsonrpc": "2.0", "method": "eth_subscription", "params": {"subscription": "0x" + kind, "result": result}} for kind, result in events]
+            for i in range(0, len(events), 2):
+                self.send(sock, events[i:i + 2])
+            gevent.sleep(0.5 if connection == 1 else 60)
+        except ConnectionError:
+            pass
+        sock.close()
+
+    def stop(self):
+        self.server.stop()
+
+def bench_subscription(args):
+    """check the websocket and ipc subscription transports against a local fake geth: subscribe, events, fallback to polling and reconnect"""
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+    from subscription import SubscriptionGreenlet
+    from hexbytes import HexBytes
+    logger = logging.getLogger("bench")
+    failed = False
+    with tempfile.TemporaryDirectory() as dir_path:
+        for kind, address, uri in (("ws", ("127.0.0.1", args.port), "ws://127.0.0.1:%d" % args.port),
+                ("ipc", socket.socket(socket.AF_UNIX), os.path.join(dir_path, "geth.ipc"))):
+            if kind == "ipc":
+                address.bind(uri)
+                address.listen(5)
+            txids = ["0x" + os.urandom(32).hex() for _ in range(3)]
+            server = FakeGethServer(kind, address, txids)
+            subscription = SubscriptionGreenlet(logger, uri, timeout=5)
+            subscription.retry_delay = 0.2
+            subscription.start()
+            checks = {}
+            # events of the first connection
+            new_heads, pending = 0, []
+            deadline = time.time() + 5
+            while (new_heads < 1 or len(pending) < 3) and time.time() < deadline:
+                subscription.wakeup.wait(1)
+                heads, txs = subscription.take_events()
+                new_heads += heads
+                pending += txs
+            checks["events"] = new_heads == 1 and pending == [HexBytes(txid) for txid in txids]
+            # the dropped connection falls back to polling
+            deadline = time.time() + 5
+            while subscription.connected and time.time() < deadline:
+                gevent.sleep(0.01)
+            checks["fallback"] = not subscription.connected
+            # and the subscription is made again on the reconnect
+            deadline = time.time() + 5
+            while not subscription.connected and time.time() < deadline:
+                gevent.sleep(0.01)
+            checks["reconnect"] = subscription.connected and server.connections == 2
+            subscription.stop_processing()
+            subscription.kill()
+            server.stop()
+            ok = all(checks.values())
+            failed = failed or not ok
+            print("%-3s transport: %s %s" % (kind, "ok" if ok else "FAIL", checks))
+    if failed:
+        sys.exit(1)
+
+def http_latencies(port, paths, connections, start, stop, results):
+    # one client process, keep alive connections in threads timing requests from start until stop is set
+    start.wait()
+    latencies = []
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while not stop.is_set():
+            request_start = time.time()
+            conn.request("GET", random.choice(paths))
+            response = conn.getresponse()
+            response.read()
+            latencies.append((time.time() - request_start) * 1000)
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(latencies)
+
+def bench_scan_stress(args):
+    """api latency (p50/p99/max) while the block scanner catches up the last --blocks blocks from geth_uri, fails above --max-p99"""
+    addresses = [random_address() for _ in range(args.accounts)]
+    paths = ["/last_blocknum", "/active_accounts"]
+    for address in addresses:
+        paths += ["/list_transactions/%s?limit=50" % address, "/incomming_value/%s" % address]
+    # the client processes are forked before the app (and its gevent monkey patching) is imported
+    start, stop, results = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=http_latencies, args=(args.port, paths, args.connections, start, stop, results)) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    import database
+    with tempfile.TemporaryDirectory() as dir_path:
+        use_scratch_app_db(dir_path)
+        from gevent.pywsgi import WSGIServer
+        import app
+        import db_settings
+        from block_check import BlockCheckGreenlet
+        from eth_blocks import get_current_block_number
+        for address in addresses:
+            app.app.test_client().get("/watch_account/%s" % address)
+        session = database.Session()
+        db_settings.set_current_block_number(session, get_current_block_number() - args.blocks)
+        session.close()
+        http_server = WSGIServer(("127.0.0.1", args.port), app.app, log=None)
+        http_server.start()
+        block_check = BlockCheckGreenlet(app.app.logger, app.account_lock)
+        scan_start = time.time()
+        start.set()
+        scan = gevent.spawn(block_check.block_check)
+        scan.join()
+        seconds = time.time() - scan_start
+        stop.set()
+        # the server has to keep answering until the clients are done, so their results are collected without blocking the hub
+        latencies = []
+        for _ in clients:
+            while True:
+                try:
+                    latencies += results.get_nowait()
+                    break
+                except queue.Empty:
+                    gevent.sleep(0.1)
+        latencies.sort()
+        for client in clients:
+            client.join()
+        http_server.stop()
+        scan.get()
+        p50, p99 = latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print("scanned %d blocks in %.2f seconds, %d api calls (%d clients x %d connections): p50 %.2f ms, p99 %.2f ms, max %.2f ms"
+            % (args.blocks, seconds, len(latencies), args.clients, args.connections, p50, p99, latencies[-1]))
+        if p99 > args.max_p99:
+            print("FAIL: p99 latency above %.1f ms" % args.max_p99)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="bench")
+    p = subparsers.add_parser("address_index", help=bench_address_index.__doc__)
+    p.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=[10000, 100000, 1000000])
+    p.add_argument("--txs-per-block", type=int, default=200)
+    p.add_argument("--blocks", type=int, default=1000)
+    p.set_defaults(func=bench_address_index)
+    p = subparsers.add_parser("add_txs", help=bench_add_txs.__doc__)
+    p.add_argument("--accounts", type=int, default=1000)
+    p.add_argument("--batches", type=int, default=100)
+    p.add_argument("--batch-size", type=int, default=200)
+    p.set_defaults(func=bench_add_txs)
+    p = subparsers.add_parser("indexes", help=bench_indexes.__doc__)
+    p.add_argument("--accounts", type=int, default=100000)
+    p.add_argument("--txs", type=int, default=2000000)
+    p.add_argument("--txs-per-block", type=int, default=2)
+    p.add_argument("--iterations", type=int, default=50)
+    p.set_defaults(func=bench_indexes)
+    p = subparsers.add_parser("storage", help=bench_storage.__doc__)
+    p.add_argument("--accounts", type=int, default=100000)
+    p.add_argument("--txs", type=int, default=1000000)
+    p.add_argument("--txs-per-block", type=int, default=2)
+    p.add_argument("--iterations", type=int, default=500)
+    p.set_defaults(func=bench_storage)
+    p = subparsers.add_parser("has_txs", help=bench_has_txs.__doc__)
+    p.add_argument("--accounts", type=int, default=200000)
+    p.add_argument("--txs", type=int, default=20000)
+    p.add_argument("--txs-per-block", type=int, default=2)
+    p.add_argument("--iterations", type=int, default=50)
+    p.set_defaults(func=bench_has_txs)
+    p = subparsers.add_parser("pending_pool", help=bench_pending_pool.__doc__)
+    p.add_argument("--txs", type=int, default=200000)
+    p.add_argument("--watched", type=int, default=10000)
+    p.add_argument("--iterations", type=int, default=20)
+    p.set_defaults(func=bench_pending_pool)
+    p = subparsers.add_parser("subscription", help=bench_subscription.__doc__)
+    p.add_argument("--port", type=int, default=5013)
+    p.set_defaults(func=bench_subscription)
+    p = subparsers.add_parser("tx_json", help=bench_tx_json.__doc__)
+    p.add_argument("--txs", type=int, default=100000)
+    p.add_argument("--txs-per-block", type=int, default=2)
+    p.add_argument("--iterations", type=int, default=3)
+    p.set_defaults(func=bench_tx_json)
+    p = subparsers.add_parser("api_load", help=bench_api_load.__doc__)
+    p.add_argument("--workers", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4])
+    p.add_argument("--accounts", type=int, default=1000)
+    p.add_argument("--clients", type=int, default=4)
+    p.add_argument("--connections", type=int, default=16)
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--port", type=int, default=5011)
+    p.set_defaults(func=bench_api_load)
+    p = subparsers.add_parser("scan_stress", help=bench_scan_stress.__doc__)
+    p.add_argument("--blocks", type=int, default=2000)
+    p.add_argument("--accounts", type=int, default=100)
+    p.add_argument("--clients", type=int, default=2)
+    p.add_argument("--connections", type=int, default=8)
+    p.add_argument("--max-p99", type=float, default=500)
+    p.add_argument("--port", type=int, default=5012)
+    p.set_defaults(func=bench_scan_stress)
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
@@ -1,11 +1,19 @@
 import time
+import collections
 import gevent
+import gevent.pool
 from gevent import Greenlet, GreenletExit
 from database import db_session
-from models import Account, Block
+from models import Account, Block, Transaction
+from address_index import active_addresses
 from config import Cfg
-from eth_blocks import get_current_block_number, get_block_hash_and_txs, get_block_hash, scan_pending_txs
-from eth_blocks import pending_tx_filter, check_tx_filter
+import db_settings
+from utils import chunks
+from eth_blocks import get_current_block_number, get_blocks_hash_and_txs, get_block_hashes, scan_pending_txs, invalidate_stored_blocks
+from eth_blocks import pending_tx_filter, check_tx_filter, add_pending_txids, set_pending_txs_persisted, take_dropped_pending_txids
+from subscription import SubscriptionGreenlet
+from change_hub import change_hub
+from response_cache import response_cache
 
 cfg = Cfg()
 
@@ -16,16 +24,40 @@ class BlockCheckGreenlet(Greenlet):
         self.logger = logger
         self.account_lock = account_lock
         self.delay = 5
+        self.min_delay = 0.5
+        # blocks below this have already been pruned (in sparse block mode)
+        self.pruned_below = 0
+        # whether we hold the account lock for uncommitted writes
+        self.writing = False
         self.keep_running = True
 
     def stop_processing(self):
         self.keep_running = False
 
     def _run(self):
-        fltr = pending_tx_filter()
+        subscription = None
+        if cfg.geth_subscribe_uri:
+            subscription = SubscriptionGreenlet(self.logger, cfg.geth_subscribe_uri, cfg.subscription_timeout)
+            subscription.start()
+        fltr = None
         tx_not_seen_counter = 0
-        while True:
+        while self.keep_running:
+            if subscription and subscription.connected:
+                # driven by subscription events, the timeout is a safety net in case any are missed
+                fltr = None
+                timed_out = not subscription.wakeup.wait(timeout=cfg.subscription_timeout)
+                new_heads, txids = subscription.take_events()
+                add_pending_txids(self.logger, txids)
+                if new_heads or timed_out or not subscription.connected:
+                    self.block_check()
+                else:
+                    self.pending_check()
+                # let a burst of events collect before the next cycle
+                gevent.sleep(self.min_delay)
+                continue
             gevent.sleep(self.delay)
+            if not fltr:
+                fltr = pending_tx_filter()
             # check for new pending transactions
             if not check_tx_filter(self.logger, fltr):
                 # replace pending tx filter if it gets stale
@@ -34,80 +66,207 @@ class BlockCheckGreenlet(Greenlet):
                     fltr = pending_tx_filter()
             # check for new blocks
             self.block_check()
+        if subscription:
+            subscription.stop_processing()
+            subscription.kill()
 
     def block_check(self):
-        # set current scanned block
-        last_block = Block.last_block(db_session)
-        if last_block:
-            current_scanned_block = last_block.num
-        else:
-            current_scanned_block = cfg.startblock
-            # check if no accounts created so we can skip to the most recent block
+        # set current scanned block, from the scan cursor or (in older dbs) our last block
+        current_scanned_block = db_settings.get_current_block_number(db_session, None)
+        if current_scanned_block is None:
+            last_block = Block.last_block(db_session)
+            if last_block:
+                current_scanned_block = last_block.num
+            else:
+                current_scanned_block = cfg.startblock
+                # check if no accounts created so we can skip to the most recent block
+                with self.account_lock:
+                    acct_count = Account.count(db_session)
+                    if acct_count == 0:
+                        current_scanned_block = get_current_block_number() - 1
+
+        # hash of our current tip (if we have one), reorgs are found by checking it against the parent of the next block
+        tip = Block.from_number(db_session, current_scanned_block)
+        tip_hash = tip.hash if tip else None
+
+        # the active address index is kept up to date by the watch/stop handlers
+        addresses = active_addresses
+
+        # scan for new blocks, when we are behind the blocks in each window are fetched
+        # concurrently (in json-rpc batches) but still applied in block order
+        current_block = get_current_block_number()
+        pool = gevent.pool.Pool(cfg.catchup_concurrency)
+        # while catching up consecutive blocks are committed together (write-behind), at the tip every block is committed
+        batch_blocks = 0
+        batch_rows = 0
+        batch_start = time.time()
+        try:
+            while current_scanned_block < current_block and self.keep_running:
+                window_end = min(current_scanned_block + cfg.catchup_window, current_block)
+                block_nums = range(current_scanned_block + 1, window_end + 1)
+                start = time.time()
+                for fetched in self.fetch_blocks(pool, block_nums, addresses):
+                    if fetched is None:
+                        # the next blocks have not been fetched yet, commit so the other writers are not held up while we wait
+                        if batch_blocks:
+                            self.commit_scan(current_scanned_block, batch_blocks, batch_rows)
+                            batch_blocks = batch_rows = 0
+                            batch_start = time.time()
+                        continue
+                    block_num, (block_hash, parent_hash, txs, tx_count) = fetched
+                    # our tip is not the parent of the next block, roll back to the fork point and rescan from there
+                    # (the rollback commits together with any blocks not committed yet)
+                    if tip_hash and parent_hash != tip_hash:
+                        self.logger.info("block %d parent does not match block %d, must have been reorged" % (block_num, block_num - 1))
+                        pool.kill()
+                        current_scanned_block = self.rollback_reorg(current_scanned_block)
+                        tip = Block.from_number(db_session, current_scanned_block)
+                        tip_hash = tip.hash if tip else None
+                        batch_blocks = batch_rows = 0
+                        batch_start = time.time()
+                        break
+                    if not self.keep_running:
+                        pool.kill()
+                        break
+                    self.begin_writes()
+                    # check for reorged blocks now reorged *back* into the main chain
+                    block = Block.from_hash(db_session, block_hash)
+                    if block:
+                        self.logger.info("block %s (was #%d) now un-reorged" % (block_hash.hex(), block.num))
+                        block.num = block_num
+                        block.parent_hash = parent_hash
+                        block.reorged = False
+                    else:
+                        block = Block(block_num, block_hash, parent_hash)
+                        db_session.add(block)
+                        db_session.flush()
+                    for key in txs.keys():
+                        self.logger.info("adding txs for " + key)
+                        for tx in txs[key]:
+                            self.logger.info(" - %s, %s" % (tx["hash"].hex(), tx["value"]))
+                    changed = Account.add_txs(db_session, block.id, txs)
+                    current_scanned_block = block_num
+                    tip_hash = block_hash
+                    batch_blocks += 1
+                    batch_rows += len(changed) + 1
+                    if block_num >= current_block or batch_blocks >= cfg.commit_max_blocks or batch_rows >= cfg.commit_max_rows \
+                            or time.time() - batch_start >= cfg.commit_max_seconds:
+                        self.commit_scan(current_scanned_block, batch_blocks, batch_rows)
+                        batch_blocks = batch_rows = 0
+                        batch_start = time.time()
+                    self.logger.info("#block# %d scan took %f seconds (%d addresses, %d txs)" % (block_num, time.time() - start, len(addresses), tx_count))
+                    start = time.time()
+                    # the blocks of a fetched batch are applied without any io, let the api greenlets in between them
+                    gevent.sleep(0)
+            if batch_blocks:
+                self.commit_scan(current_scanned_block, batch_blocks, batch_rows)
+        except:
+            # nothing after the last commit (including the cursor) is kept
+            db_session.rollback()
+            self.end_writes()
+            raise
+
+        # drop the blocks that have left the reorg window and have none of our txs in them
+        if cfg.sparse_blocks and current_scanned_block - cfg.reorg_window > self.pruned_below:
+            before_num = current_scanned_block - cfg.reorg_window
             with self.account_lock:
-                acct_count = Account.count(db_session)
-                if acct_count == 0:
-                    current_scanned_block = get_current_block_number() - 1
-
-        # check for reorgs and invalidate any blocks (and associated txs)
-        block_num = current_scanned_block
-        block = Block.from_number(db_session, current_scanned_block)
-        if block:
-            any_reorgs = False
-            block_hash = get_block_hash(block_num)
-            if not block_hash:
-                self.logger.error("unable to get hash for block %d" % block_num)
-                return
-            while block_hash != block.hash:
-                self.logger.info("block %d hash does not match current blockchain, must have been reorged" % block_num)
-                block.set_reorged(db_session)
-                any_reorgs = True
-                # decrement block_num, set new current_scanned_block
-                block_num -= 1
-                current_scanned_block = block_num
-                # now do the previous block
-                block = Block.from_number(db_session, block_num)
-                if not block:
-                    break
-                block_hash = get_block_hash(block_num)
-            if any_reorgs:
+                count = Block.prune(db_session, before_num, self.pruned_below or None)
                 db_session.commit()
+            self.pruned_below = before_num
+            self.logger.info("pruned %d blocks below %d" % (count, before_num))
 
-        # get address list from db
-        with self.account_lock:
-            addresses = Account.all_active_addresses(db_session)
+        self.pending_check()
 
-        # scan for new blocks
-        current_block = get_current_block_number()
-        while current_scanned_block < current_block and self.keep_running:
-            block_num = current_scanned_block + 1
-            start = time.time()
-            block_hash, txs, tx_count = get_block_hash_and_txs(block_num, addresses)
-            # check for reorged blocks now reorged *back* into the main chain
-            block = Block.from_hash(db_session, block_hash)
-            if block:
-                self.logger.info("block %s (was #%d) now un-reorged" % (block_hash.hex(), block.num))
-                block.num = block_num
-                block.reorged = False
+    def fetch_blocks(self, pool, block_nums, addresses):
+        """Yields (block_num, block) of block_nums in order, fetched in concurrent json-rpc batches.
+
+        Yields None before it waits on a batch that has not been fetched yet.
+        """
+        batches = iter(chunks(block_nums, cfg.rpc_batch_size))
+        fetching = collections.deque()
+        while True:
+            while not pool.full():
+                nums = next(batches, None)
+                if nums is None:
+                    break
+                fetching.append((nums, pool.spawn(get_blocks_hash_and_txs, nums, addresses)))
+            if not fetching:
+                return
+            nums, batch = fetching.popleft()
+            if not batch.ready():
+                yield None
+            yield from zip(nums, batch.get())
+
+    def begin_writes(self):
+        # a batch of blocks is written across yields (while the fetched blocks are applied) so the account lock
+        # is held from its first write until its commit, the other writers wait for it instead of hitting a locked db
+        # (the batch is committed before waiting on the rpc, so that wait is never under the lock)
+        if not self.writing:
+            self.account_lock.acquire()
+            self.writing = True
+
+    def end_writes(self):
+        if self.writing:
+            self.writing = False
+            self.account_lock.release()
+
+    def commit_scan(self, block_num, batch_blocks, batch_rows):
+        # the cursor is written in the same transaction as the blocks so after a crash it can never be ahead of them
+        self.begin_writes()
+        db_settings.set_current_block_number(db_session, block_num, commit=False)
+        db_session.commit()
+        self.end_writes()
+        change_hub.refresh(db_session)
+        response_cache.invalidate("last_blocknum", block_num)
+        if batch_blocks > 1:
+            self.logger.info("committed %d blocks (%d rows) up to block %d" % (batch_blocks, batch_rows, block_num))
+
+    def rollback_reorg(self, tip_num):
+        """Roll back the blocks above the fork point of a reorg (in one db transaction), returns the fork point block number."""
+        self.begin_writes()
+        first_num = Block.first_block_num(db_session)
+        end = tip_num
+        fork_num = None
+        while fork_num is None:
+            # compare a batch of our stored ancestors with the chain, newest first
+            start = end - cfg.reorg_batch_size + 1
+            stored = Block.range(db_session, start, end)
+            nums = sorted(stored.keys(), reverse=True)
+            for num, block_hash in zip(nums, get_block_hashes(nums)):
+                if block_hash == stored[num].hash:
+                    fork_num = num
+                    break
             else:
-                block = Block(block_num, block_hash)
-                db_session.add(block)
-                db_session.flush()
-            for key in txs.keys():
-                self.logger.info("adding txs for " + key)
-                for tx in txs[key]:
-                    self.logger.info(" - %s, %s" % (tx["hash"].hex(), tx["value"]))
-                Account.add_txs(db_session, key, block.id, txs[key])
-            db_session.commit()
-            current_scanned_block = block_num
-            self.logger.info("#block# %d scan took %f seconds (%d addresses, %d txs)" % (block_num, time.time() - start, len(addresses), tx_count))
+                end = start - 1
+                if first_num is None or end < first_num:
+                    # none of our blocks are on the chain anymore
+                    fork_num = end
+        count = Block.rollback(db_session, fork_num)
+        db_settings.set_current_block_number(db_session, fork_num, commit=False)
+        db_session.commit()
+        self.end_writes()
+        change_hub.refresh(db_session)
+        response_cache.invalidate("last_blocknum", fork_num)
+        invalidate_stored_blocks(fork_num)
+        self.logger.info("reorg of %d blocks rolled back to block %d" % (count, fork_num))
+        return fork_num
 
+    def pending_check(self):
         # scan for pending transactions
+        addresses = active_addresses
         start = time.time()
-        txs, tx_count = scan_pending_txs(addresses)
+        txs, tx_count = scan_pending_txs()
         for key in txs.keys():
             self.logger.info("adding txs for " + key)
             for tx in txs[key]:
                 self.logger.info(" - %s, %s" % (tx["hash"].hex(), tx["value"]))
-            Account.add_txs(db_session, key, None, txs[key])
-        db_session.commit()
+        # only new pending txs and dropped ones are written, the rest are already in the db
+        dropped = take_dropped_pending_txids()
+        with self.account_lock:
+            Account.add_txs(db_session, None, txs)
+            if dropped:
+                self.logger.info("marked %d pending txs as dropped" % Transaction.set_dropped(db_session, dropped))
+            db_session.commit()
+        set_pending_txs_persisted(txs)
+        change_hub.refresh(db_session)
         self.logger.info("!pending! tx scan took %f seconds (%d addresses, %d txs)" % (time.time() - start, len(addresses), tx_count))
\ No newline at end of file
@@ -0,0 +1,116 @@
+import os
+import mmap
+import struct
+from hexbytes import HexBytes
+
+# index file: one slot per block number (data offset, record length), a zero length slot is a missing block
+SLOT = struct.Struct("<QI")
+# data file records: header then one entry per tx
+HEADER = struct.Struct("<Q32s32sI")
+TX = struct.Struct("<32s20s?20s32s")
+
+def encode_block(block_num, block_hash, parent_hash, txs):
+    parts = [HEADER.pack(block_num, bytes(block_hash), bytes(parent_hash), len(txs))]
+    for tx in txs:
+        to = tx["to"]
+        parts.append(TX.pack(bytes(tx["hash"]), bytes.fromhex(tx["from"][2:]), to is not None,
+            bytes.fromhex(to[2:]) if to else b"", tx["value"].to_bytes(32, "big")))
+    return b"".join(parts)
+
+def decode_block(data):
+    block_num, block_hash, parent_hash, count = HEADER.unpack_from(data)
+    txs = []
+    for txhash, from_, has_to, to, value in TX.iter_unpack(data[HEADER.size:HEADER.size + count * TX.size]):
+        txs.append({"hash": HexBytes(txhash), "from": "0x" + from_.hex(), "to": "0x" + to.hex() if has_to else None, "value": int.from_bytes(value, "big")})
+    return block_num, HexBytes(block_hash), HexBytes(parent_hash), txs
+
+class BlockStore():
+    """Append only local store of the parts of each block the scanner needs.
+
+    Records (number, hash, parent hash and the (hash, from, to, value) of each
+    tx) are appended to a data file and located through a fixed size slot per
+    block number in a (sparse) index file. Both files are memory mapped for
+    reading so other processes can read the store while the scanner appends.
+    Only blocks deep enough to be final should be put in the store, `put`
+    never overwrites a filled slot (slots are only cleared by `invalidate`).
+    """
+
+    def __init__(self, dir_path, readonly=False):
+        self.readonly = readonly
+        self.index_path = os.path.join(dir_path, "blocks.idx")
+        self.data_path = os.path.join(dir_path, "blocks.dat")
+        mode = "rb"
+        if not readonly:
+            # create the files so they can be opened for update
+            os.makedirs(dir_path, exist_ok=True)
+            open(self.index_path, "a").close()
+            open(self.data_path, "a").close()
+            mode = "r+b"
+        self.index = open(self.index_path, mode)
+        self.data = open(self.data_path, mode)
+        self.index_map = None
+        self.data_map = None
+
+    def _map(self, f, current, size):
+        # (re)map a file if it has grown past what we have mapped
+        if current is not None and len(current) >= size:
+            return current
+        if os.fstat(f.fileno()).st_size < size:
+            return current
+        if current is not None:
+            current.close()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _slot(self, block_num):
+        pos = block_num * SLOT.size
+        self.index_map = self._map(self.index, self.index_map, pos + SLOT.size)
+        if self.index_map is None or len(self.index_map) < pos + SLOT.size:
+            return 0, 0
+        return SLOT.unpack_from(self.index_map, pos)
+
+    def has(self, block_num):
+        return self._slot(block_num)[1] > 0
+
+    def get(self, block_num):
+        """Return (hash, parent hash, txs) of a stored block or None."""
+        offset, length = self._slot(block_num)
+        if not length:
+            return None
+        self.data_map = self._map(self.data, self.data_map, offset + length)
+        stored_num, block_hash, parent_hash, txs = decode_block(self.data_map[offset:offset + length])
+        if stored_num != block_num:
+            return None
+        return block_hash, parent_hash, txs
+
+    def put(self, block_num, block_hash, parent_hash, txs):
+        assert not self.readonly
+        if self.has(block_num):
+            return False
+        record = encode_block(block_num, block_hash, parent_hash, txs)
+        # write the record before its slot so a crash can only leave an unreferenced record
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(record)
+        self.data.flush()
+        self.index.seek(block_num * SLOT.size)
+        self.index.write(SLOT.pack(offset, len(record)))
+        self.index.flush()
+        return True
+
+    def invalidate(self, after_num):
+        """Clear the slots of the blocks above after_num (after a reorg deeper than we expected)."""
+        assert not self.readonly
+        # slots are zeroed rather than the file truncated, readers may have the index mapped
+        size = os.fstat(self.index.fileno()).st_size
+        pos = (after_num + 1) * SLOT.size
+        if size > pos:
+            self.index.seek(pos)
+            self.index.write(bytes(size - pos))
+            self.index.flush()
+
+    def close(self):
+        for m in (self.index_map, self.data_map):
+            if m is not None:
+                m.close()
+        self.index.close()
+        self.data.close()
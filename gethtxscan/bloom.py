@@ -0,0 +1,66 @@
+import math
+import hashlib
+
+class BloomFilter():
+    """Fixed size bloom filter of strings, no false negatives and about error_rate false positives at capacity."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing, k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+class AddressTxFilter():
+    """Process wide bloom filter of the addresses that have any transaction.
+
+    Addresses are only ever added (reorged txs leave false positives behind),
+    so an address that is not in the filter definitely has no transactions.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.filter = BloomFilter(capacity, error_rate)
+
+    def load(self, addresses, capacity, error_rate=0.01):
+        addresses = list(addresses)
+        bloom = BloomFilter(max(capacity, 2 * len(addresses)), error_rate)
+        bloom.update(addresses)
+        self.filter = bloom
+
+    def add(self, address):
+        self.filter.add(address)
+
+    def __contains__(self, address):
+        return address in self.filter
+
+    def __len__(self):
+        return len(self.filter)
+
+addresses_with_txs = AddressTxFilter()
@@ -0,0 +1,42 @@
+import gevent
+from gevent import Greenlet
+from database import Session
+from change_hub import change_hub
+from response_cache import response_cache
+import db_settings
+
+class ChangeFollowerGreenlet(Greenlet):
+    """Keeps a read only api worker process in step with the scanner process.
+
+    The scanner is the only writer, so a worker polls what it commits: the tx
+    change log (through the change hub, which invalidates the cached responses
+    of the changed accounts and wakes the /stream subscribers), the scan
+    cursor and the version of the watched account set.
+    """
+
+    def __init__(self, logger, delay=1):
+        Greenlet.__init__(self)
+        self.logger = logger
+        self.delay = delay
+        self.keep_running = True
+        self.session = Session()
+
+    def stop_processing(self):
+        self.keep_running = False
+
+    def _run(self):
+        while self.keep_running:
+            gevent.sleep(self.delay)
+            try:
+                self.follow()
+            except Exception:
+                self.logger.exception("following the scanner failed")
+            finally:
+                # do not hold a read transaction (and the wal) open between polls
+                self.session.rollback()
+
+    def follow(self):
+        change_hub.refresh(self.session)
+        # the cached responses are versioned by these values so every worker has the same etags
+        response_cache.invalidate("last_blocknum", db_settings.get_current_block_number(self.session, -1))
+        response_cache.invalidate("active_accounts", db_settings.get_accounts_version(self.session))
@@ -0,0 +1,84 @@
+import json
+import collections
+from gevent.event import Event
+from models import TxChange
+from response_cache import response_cache
+from bloom import addresses_with_txs
+
+class ChangeHub():
+    """Fans the tx change log out to the /stream subscribers.
+
+    Committed changes are picked up by `refresh` (called by the writers after
+    they commit) into a ring buffer of serialized events, then every waiting
+    subscriber is woken through one shared Event. `refresh` also invalidates
+    the cached responses of the changed accounts and adds them to the has txs
+    filter, so a read only api worker stays in step with the writer by
+    refreshing its hub. Subscribers that are further
+    behind than the buffer catch up from the db first.
+    """
+
+    def __init__(self, size=10000):
+        self.events = collections.deque(maxlen=size)
+        self.last_seq = 0
+        self.event = Event()
+
+    def start(self, last_seq):
+        self.last_seq = last_seq
+
+    def refresh(self, session):
+        # pick up the changes committed since the last refresh and wake the subscribers
+        count = 0
+        while True:
+            changes = TxChange.since(session, self.last_seq, 1000)
+            for change in changes:
+                self.events.append(self.serialize(change))
+                # only the cached responses of the accounts that changed are dropped
+                response_cache.invalidate_account(change.to, change.seq)
+                # the writer adds to the filter itself, the api workers only learn of new txs here
+                if change.to not in addresses_with_txs:
+                    addresses_with_txs.add(change.to)
+            if changes:
+                self.last_seq = changes[-1].seq
+                count += len(changes)
+            if len(changes) < 1000:
+                break
+        if count:
+            event, self.event = self.event, Event()
+            event.set()
+        return count
+
+    def serialize(self, change):
+        # (seq, recipient, json) so each event is only encoded once for all subscribers
+        return change.seq, change.to, json.dumps(change.to_json(), sort_keys=True)
+
+    def buffered_since(self, seq):
+        # the buffered events after seq, or None if seq is older than the buffer
+        if seq < self.last_seq and (not self.events or seq < self.events[0][0] - 1):
+            return None
+        result = []
+        for event in reversed(self.events):
+            if event[0] <= seq:
+                break
+            result.append(event)
+        result.reverse()
+        return result
+
+    def subscribe(self, session, seq, timeout=15):
+        """Yield lists of the events after seq as they arrive, an empty list when there were none for `timeout` seconds."""
+        while True:
+            # take the current event before looking so a refresh in between is not missed
+            event = self.event
+            events = self.buffered_since(seq)
+            if events is None:
+                events = [self.serialize(change) for change in TxChange.since(session, seq, 1000)]
+                # do not hold a read transaction open between pages
+                session.rollback()
+            if events:
+                seq = events[-1][0]
+                yield events
+            else:
+                event.wait(timeout)
+                if not event.is_set():
+                    yield []
+
+change_hub = ChangeHub()
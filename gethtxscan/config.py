@@ -13,3 +13,36 @@ class Cfg():
         else:
             self.startblock = configParser.getint("main", "startblock")
         self.geth_uri = configParser.get("main", "geth_uri")
+        self.geth_subscribe_uri = configParser.get("main", "geth_subscribe_uri", fallback="")
+        self.subscription_timeout = configParser.getint("main", "subscription_timeout", fallback=60)
+        self.rpc_batch_size = configParser.getint("main", "rpc_batch_size", fallback=50)
+        self.pending_batch_size = configParser.getint("main", "pending_batch_size", fallback=200)
+        self.pending_pool_max_size = configParser.getint("main", "pending_pool_max_size", fallback=200000)
+        self.pending_lookup_cap = configParser.getint("main", "pending_lookup_cap", fallback=5000)
+        self.pending_lookup_concurrency = configParser.getint("main", "pending_lookup_concurrency", fallback=4)
+        self.catchup_window = configParser.getint("main", "catchup_window", fallback=400)
+        self.catchup_concurrency = configParser.getint("main", "catchup_concurrency", fallback=8)
+        self.commit_max_blocks = configParser.getint("main", "commit_max_blocks", fallback=200)
+        self.commit_max_seconds = configParser.getfloat("main", "commit_max_seconds", fallback=5)
+        self.commit_max_rows = configParser.getint("main", "commit_max_rows", fallback=10000)
+        self.sparse_blocks = configParser.getboolean("main", "sparse_blocks", fallback=False)
+        self.reorg_window = configParser.getint("main", "reorg_window", fallback=128)
+        self.reorg_batch_size = configParser.getint("main", "reorg_batch_size", fallback=64)
+        self.backfill_on_watch = configParser.getboolean("main", "backfill_on_watch", fallback=True)
+        self.backfill_workers = configParser.getint("main", "backfill_workers", fallback=4)
+        self.backfill_chunk_size = configParser.getint("main", "backfill_chunk_size", fallback=200)
+        self.blockstore = configParser.getboolean("main", "blockstore", fallback=False)
+        self.blockstore_confirmations = configParser.getint("main", "blockstore_confirmations", fallback=12)
+        self.has_txs_temp_table_threshold = configParser.getint("main", "has_txs_temp_table_threshold", fallback=500)
+        self.has_txs_bloom_capacity = configParser.getint("main", "has_txs_bloom_capacity", fallback=1000000)
+        self.response_cache_accounts = configParser.getint("main", "response_cache_accounts", fallback=10000)
+        self.writer_uri = configParser.get("main", "writer_uri", fallback="http://127.0.0.1:5002")
+        self.api_workers = configParser.getint("main", "api_workers", fallback=4)
+        self.worker_poll_interval = configParser.getfloat("main", "worker_poll_interval", fallback=1)
+        self.storage_mode = configParser.get("main", "storage_mode", fallback="text")
+        self.db_pool_size = configParser.getint("main", "db_pool_size", fallback=10)
+        self.db_pool_overflow = configParser.getint("main", "db_pool_overflow", fallback=-1)
+        self.sqlite_journal_mode = configParser.get("main", "sqlite_journal_mode", fallback="wal")
+        self.sqlite_synchronous = configParser.get("main", "sqlite_synchronous", fallback="normal")
+        self.sqlite_cache_size = configParser.getint("main", "sqlite_cache_size", fallback=-65536)
+        self.sqlite_mmap_size = configParser.getint("main", "sqlite_mmap_size", fallback=268435456)
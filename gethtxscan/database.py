@@ -1,18 +1,35 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import os
+import gevent
 from config import Cfg
 
 cfg = Cfg()
 dir_path = os.path.dirname(os.path.realpath(__file__))
-if cfg.testnet:
-    engine = create_engine("sqlite:///%s/gethtxscan_testnet.db" % dir_path, convert_unicode=True)
-else:
-    engine = create_engine("sqlite:///%s/gethtxscan.db" % dir_path, convert_unicode=True)
-db_session = scoped_session(sessionmaker(autocommit=False,
-                                         autoflush=False,
-                                         bind=engine))
+db_name = "gethtxscan_testnet.db" if cfg.testnet else "gethtxscan.db"
+# a pool of connections shared by the greenlets (and the threadpool, so connections are not bound to one thread)
+engine = create_engine("sqlite:///%s/%s" % (dir_path, db_name), convert_unicode=True, poolclass=QueuePool,
+        pool_size=cfg.db_pool_size, max_overflow=cfg.db_pool_overflow, connect_args={"check_same_thread": False})
+
+def apply_storage_profile(engine, journal_mode, synchronous, cache_size, mmap_size):
+    # sqlite pragmas are per connection so set them whenever one is opened
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=%s" % journal_mode)
+        cursor.execute("PRAGMA synchronous=%s" % synchronous)
+        cursor.execute("PRAGMA cache_size=%d" % cache_size)
+        cursor.execute("PRAGMA mmap_size=%d" % mmap_size)
+        cursor.close()
+
+apply_storage_profile(engine, cfg.sqlite_journal_mode, cfg.sqlite_synchronous, cfg.sqlite_cache_size, cfg.sqlite_mmap_size)
+Session = sessionmaker(autocommit=False,
+                       autoflush=False,
+                       bind=engine)
+# one session per greenlet (each request and each scanner greenlet), a greenlet must remove its session when it is done
+db_session = scoped_session(Session, scopefunc=gevent.getcurrent)
 Base = declarative_base()
 Base.query = db_session.query_property()
 
@@ -21,4 +38,21 @@ def init_db():
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     import models
+    import migrations
     Base.metadata.create_all(bind=engine)
+    migrations.migrate(db_session)
+    models.set_compact_storage(migrations.get_storage_mode(db_session) == "compact")
+
+def run_in_threadpool(fn, *args):
+    """Run fn(session, *args) with its own session in the gevent threadpool.
+
+    sqlite calls block the thread they run on, so slow queries are run in a
+    threadpool thread to keep the other greenlets going while they wait.
+    """
+    def run():
+        session = Session()
+        try:
+            return fn(session, *args)
+        finally:
+            session.close()
+    return gevent.get_hub().threadpool.apply(run)
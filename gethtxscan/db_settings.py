@@ -1,22 +1,39 @@
-from gethtxscan.models import Setting
+from models import Setting
 
-def set_value(db_session, keyname, value):
-    setting = Setting.query.filter(Setting.key == keyname).first()
+def set_value(db_session, keyname, value, commit=True):
+    setting = db_session.query(Setting).filter(Setting.key == keyname).first()
     if not setting:
         setting = Setting(keyname, value)
     else:
         setting.value = value
     db_session.add(setting)
-    db_session.commit()
+    if commit:
+        db_session.commit()
 
-def get_value(keyname, default):
-    setting = Setting.query.filter(Setting.key == keyname).first()
+def get_value(db_session, keyname, default):
+    setting = db_session.query(Setting).filter(Setting.key == keyname).first()
     if not setting:
         return default
     return setting.value
 
-def set_current_block_number(db_session, blocknum):
-    set_value(db_session, "currentblock", blocknum)
+def set_current_block_number(db_session, blocknum, commit=True):
+    set_value(db_session, "currentblock", blocknum, commit)
 
-def get_current_block_number(default):
-    return int(get_value("currentblock", default))
+def get_current_block_number(db_session, default):
+    value = get_value(db_session, "currentblock", None)
+    if value is None:
+        return default
+    return int(value)
+
+def set_schema_version(db_session, version):
+    set_value(db_session, "schema_version", version)
+
+def get_schema_version(db_session):
+    return int(get_value(db_session, "schema_version", 0))
+
+def bump_accounts_version(db_session):
+    # lets the api workers know the set of watched accounts changed (committed with the change)
+    set_value(db_session, "accounts_version", get_accounts_version(db_session) + 1, commit=False)
+
+def get_accounts_version(db_session):
+    return int(get_value(db_session, "accounts_version", 0))
@@ -1,91 +1,206 @@
+import os
 import requests
 import time
+import collections
+import gevent.pool
 import web3
+from hexbytes import HexBytes
 from config import Cfg
+from rpc import BatchRpc, RpcError
+from utils import chunks
+from blockstore import BlockStore
+from pending_pool import PendingPool
+from address_index import active_addresses
 
 cfg = Cfg()
 web3 = web3.Web3(web3.providers.rpc.HTTPProvider(cfg.geth_uri, request_kwargs={'timeout': 60}))
-if cfg.testnet:
-    assert(int(web3.version.network) == 3) #ropsten
-else:
-    assert(int(web3.version.network) == 1) #mainnet
+# batched json-rpc transport for the bulk calls
+rpc = BatchRpc(cfg.geth_uri, timeout=60)
+# local store of confirmed blocks so rescans and backfills do not have to refetch them from geth
+block_store = None
+if cfg.blockstore:
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    block_store = BlockStore(os.path.join(dir_path, "blockstore_testnet" if cfg.testnet else "blockstore"))
+# highest block number geth has reported, blocks are only stored once they are deep enough below it
+latest_block_num = 0
 
-# pool of pending transactions
-pending_txs = {}
+# pool of pending transactions, matched against the watched addresses as they are added
+pending_txs = PendingPool(cfg.pending_pool_max_size, lambda to: to in active_addresses)
+# txids waiting to be looked up (in the order they were seen) and stats of the lookup cycles
+pending_lookup_queue = collections.OrderedDict()
+pending_lookup_stats = {"cycles": 0, "looked_up": 0, "found": 0, "dropped": 0, "last": {}}
+
+def check_network():
+    # geth must be on the network we are configured for (checked at startup, not on import)
+    if cfg.testnet:
+        assert(int(web3.version.network) == 3) #ropsten
+    else:
+        assert(int(web3.version.network) == 1) #mainnet
+
+def tx_record(tx):
+    # convert a raw json-rpc transaction into the fields we track
+    to = tx["to"]
+    if to:
+        to = to.lower()
+    return {"to": to, "from": tx["from"].lower(), "hash": HexBytes(tx["hash"]), "value": int(tx["value"], 16)}
 
 def get_current_block_number():
-    return web3.eth.blockNumber
+    global latest_block_num
+    block_num = int(rpc.call("eth_blockNumber"), 16)
+    latest_block_num = max(latest_block_num, block_num)
+    return block_num
 
-def get_block_hash_and_txs(block_num, addresses):
-    txs = {}
-    block = web3.eth.getBlock(block_num, True)
-    block_transactions = block.transactions
+def get_latest_block_num():
+    # the highest chain head seen, the scanner may have fetched (and matched) blocks up to here
+    return latest_block_num
+
+def block_record(block):
+    # convert a raw json-rpc block into (hash, parent hash, tx records)
+    block_transactions = block["transactions"]
     if not block_transactions:
         block_transactions = []
+    return HexBytes(block["hash"]), HexBytes(block["parentHash"]), [tx_record(tx) for tx in block_transactions]
+
+def parse_block_txs(block_hash, parent_hash, block_transactions, addresses):
+    txs = {}
     for tx in block_transactions:
         # remove from pending_txs if found in a block
-        if tx["hash"] in pending_txs:
-            del pending_txs[tx["hash"]]
-        if tx["to"]:
-            to = tx["to"].lower()
-            if to in addresses:
-                if to in txs:
-                    txs[to].append(tx)
-                else:
-                    txs[to] = [tx]
-    return block.hash, txs, len(block_transactions)
-
-def get_block_hash(block_num):
-    block = web3.eth.getBlock(block_num, False)
-    if block:
-        return block.hash
-    return None
-
-def scan_pending_txs(addresses):
-    txs = {}
-    remove = []
-    _5hours = 60 * 60 * 5
-    now = time.time()
-    for key, item in pending_txs.items():
-        timestamp, tx = item
-        to = tx["to"]
-        if to in addresses:
+        pending_txs.remove(tx["hash"])
+    # match all the recipients of the block in one go
+    matches = addresses.match([tx["to"] for tx in block_transactions])
+    for tx, match in zip(block_transactions, matches):
+        if match:
+            to = tx["to"]
             if to in txs:
                 txs[to].append(tx)
             else:
                 txs[to] = [tx]
-        # mark all pending txs in the pool for longer then _5hours
-        if now - timestamp > _5hours:
-            remove.append(key)
-    # remove all expired txs from pending_txs
-    for key in remove:
-        del pending_txs[key]
-    return txs, len(pending_txs)
+    return block_hash, parent_hash, txs, len(block_transactions)
+
+def get_blocks_hash_and_txs(block_nums, addresses, batch_rpc=None):
+    records = {}
+    if block_store:
+        for block_num in block_nums:
+            record = block_store.get(block_num)
+            if record:
+                records[block_num] = record
+    # only fetch the blocks that are not in the local store
+    missing = [block_num for block_num in block_nums if block_num not in records]
+    calls = [("eth_getBlockByNumber", [hex(block_num), True]) for block_num in missing]
+    blocks = (batch_rpc or rpc).batch_chunked(calls, cfg.rpc_batch_size)
+    for block_num, block in zip(missing, blocks):
+        if not block:
+            raise RpcError("block %d not found" % block_num)
+        record = block_record(block)
+        if block_store and block_num <= latest_block_num - cfg.blockstore_confirmations:
+            block_store.put(block_num, *record)
+        records[block_num] = record
+    return [parse_block_txs(*records[block_num], addresses) for block_num in block_nums]
+
+def invalidate_stored_blocks(after_num):
+    # the store only holds confirmed blocks but a reorg can still be deeper than that
+    if block_store:
+        block_store.invalidate(after_num)
+
+def get_block_hashes(block_nums):
+    calls = [("eth_getBlockByNumber", [hex(block_num), False]) for block_num in block_nums]
+    blocks = rpc.batch_chunked(calls, cfg.rpc_batch_size)
+    return [HexBytes(block["hash"]) if block else None for block in blocks]
+
+def scan_pending_txs():
+    # expire all pending txs in the pool for longer then _5hours
+    _5hours = 60 * 60 * 5
+    pending_txs.expire(_5hours)
+    # only the matched txs that have not been written to the db yet
+    return pending_txs.matches(unpersisted=True), len(pending_txs)
+
+def load_pending_txs(rows):
+    # track the pending txs already in the db (from before a restart) so they are marked dropped if they expire without being mined
+    now = time.time()
+    count = 0
+    for txid, from_, to, value in rows:
+        txid = HexBytes(txid)
+        pending_txs.add(txid, now, {"hash": txid, "from": from_, "to": to, "value": value})
+        pending_txs.set_persisted([txid])
+        count += 1
+    return count
+
+def set_pending_txs_persisted(txs):
+    pending_txs.set_persisted(tx["hash"] for address_txs in txs.values() for tx in address_txs)
+
+def take_dropped_pending_txids():
+    # txids of persisted pending txs that expired or were evicted without being mined
+    return pending_txs.take_dropped()
 
 def pending_tx_filter():
     return web3.eth.filter("pending")
 
-def check_tx_filter(logger, filter):
-    def get_pending_tx_record(txid):
-        tx = web3.eth.getTransaction(txid)
+def add_pending_txids(logger, seen_txids):
+    def get_pending_tx_record(txid, tx):
         if not tx:
             logger.error("could not get tx info (%s)" % txid.hex())
+        elif tx.get("blockNumber"):
+            # mined while it was waiting to be looked up, the block scan will pick it up
+            pass
         elif tx["to"]:
-            tx = {"to": tx["to"].lower(), "from": tx["from"].lower(), "hash": tx["hash"], "value": tx["value"]}
-            return (time.time(), tx)
+            return (time.time(), tx_record(tx))
         else:
             logger.info("could not get tx 'to' info, possibly contract stuff (%s)" % txid.hex())
 
-    seen_txids = filter.get_new_entries()
+    def lookup(txids):
+        start = time.time()
+        calls = [("eth_getTransactionByHash", ["0x" + bytes(txid).hex()]) for txid in txids]
+        return txids, rpc.batch(calls), time.time() - start
+
+    start = time.time()
+    new = 0
     for txid in seen_txids:
         logger.info("!new tx! {0}".format(txid.hex()))
-        # add transaction to pending transaction pool
-        if not txid in pending_txs:
-            record = None
-            record = get_pending_tx_record(txid)
+        if not txid in pending_txs and not txid in pending_lookup_queue:
+            pending_lookup_queue[txid] = True
+            new += 1
+    # drop the oldest queued txids if we keep falling behind
+    dropped = 0
+    while len(pending_lookup_queue) > cfg.pending_lookup_cap * 10:
+        pending_lookup_queue.popitem(last=False)
+        dropped += 1
+    # look up to pending_lookup_cap txids this cycle, the rest are carried over to the next one
+    txids = []
+    while pending_lookup_queue and len(txids) < cfg.pending_lookup_cap:
+        txids.append(pending_lookup_queue.popitem(last=False)[0])
+    # the batches are fetched concurrently and added to the pending transaction pool as they arrive
+    found = 0
+    latencies = []
+    pool = gevent.pool.Pool(cfg.pending_lookup_concurrency)
+    for batch, txs, elapsed in pool.imap_unordered(lookup, chunks(txids, cfg.pending_batch_size)):
+        latencies.append(elapsed)
+        for txid, tx in zip(batch, txs):
+            record = get_pending_tx_record(txid, tx)
             if record:
-                pending_txs[txid] = record
+                pending_txs.add(txid, *record)
+                found += 1
+    latencies.sort()
+    last = {"seen": len(seen_txids), "new": new, "looked_up": len(txids), "found": found, "carried_over": len(pending_lookup_queue), "dropped": dropped,
+        "batches": len(latencies), "batch_seconds_median": latencies[len(latencies) // 2] if latencies else 0.0, "batch_seconds_max": latencies[-1] if latencies else 0.0,
+        "seconds": time.time() - start}
+    pending_lookup_stats["cycles"] += 1
+    pending_lookup_stats["looked_up"] += len(txids)
+    pending_lookup_stats["found"] += found
+    pending_lookup_stats["dropped"] += dropped
+    pending_lookup_stats["last"] = last
+    if txids:
+        logger.info("!pending! looked up %d txs (%d found, %d carried over) in %f seconds" % (len(txids), found, len(pending_lookup_queue), last["seconds"]))
+
+def check_tx_filter(logger, filter):
+    seen_txids = filter.get_new_entries()
+    add_pending_txids(logger, seen_txids)
     return seen_txids
 
 def get_pending_txs():
     return pending_txs
+
+def get_pending_lookup_stats():
+    return pending_lookup_stats
+
+def get_rpc_stats():
+    return rpc.stats
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Maintenance commands for the gethtxscan db."""
+
+import os
+import sys
+import argparse
+from sqlalchemy import text
+from database import db_session, init_db, engine
+from models import AccountTotal, Block, set_compact_storage
+from config import Cfg
+import migrations
+import db_settings
+
+def check_totals(args):
+    """recompute the account totals from the transactions and compare with the stored totals"""
+    totals = AccountTotal.compute_all(db_session)
+    stored = {total.account_id: (total.confirmed, total.pending) for total in db_session.query(AccountTotal)}
+    bad = 0
+    for account_id in set(totals.keys()) | set(stored.keys()):
+        expected = totals.get(account_id, (0, 0))
+        actual = stored.get(account_id, (0, 0))
+        if expected != actual:
+            bad += 1
+            print("account %d: stored %s, expected %s" % (account_id, actual, expected))
+    print("%d accounts checked, %d totals inconsistent" % (len(totals), bad))
+    if bad and args.fix:
+        AccountTotal.rebuild(db_session, totals)
+        db_session.commit()
+        print("totals rebuilt")
+    return bad == 0 or args.fix
+
+def vacuum(engine):
+    # vacuum and checkpoint so the db file reflects the space actually used
+    with engine.connect() as conn:
+        conn.execute(text("VACUUM"))
+        conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    return os.path.getsize(engine.url.database)
+
+def convert_storage(args):
+    """convert the db in place to the compact (binary) or text storage mode"""
+    compact = args.mode == "compact"
+    if migrations.get_storage_mode(db_session) == args.mode:
+        print("db is already in %s storage mode" % args.mode)
+        return True
+    db_session.close()
+    size = vacuum(engine)
+    migrations.convert_storage(db_session, compact)
+    set_compact_storage(compact)
+    db_session.close()
+    new_size = vacuum(engine)
+    print("converted db to %s storage mode, size %d -> %d bytes" % (args.mode, size, new_size))
+    return True
+
+def compact(args):
+    """delete the blocks that are not referenced by any transaction (except the reorg window) and vacuum the db"""
+    last_block = Block.last_block(db_session)
+    if not last_block:
+        print("no blocks stored")
+        return True
+    # the scanner resumes from the cursor once the older blocks are gone
+    current_block = db_settings.get_current_block_number(db_session, None)
+    if current_block is None:
+        current_block = last_block.num
+        db_settings.set_current_block_number(db_session, current_block, commit=False)
+    db_session.commit()
+    db_session.close()
+    size = vacuum(engine)
+    count = Block.prune(db_session, current_block - args.keep)
+    db_session.commit()
+    db_session.close()
+    new_size = vacuum(engine)
+    print("deleted %d blocks, size %d -> %d bytes (%d bytes saved)" % (count, size, new_size, size - new_size))
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    p = subparsers.add_parser("check_totals", help=check_totals.__doc__)
+    p.add_argument("--fix", action="store_true", help="rebuild the totals if they are inconsistent")
+    p.set_defaults(func=check_totals)
+    p = subparsers.add_parser("convert_storage", help=convert_storage.__doc__)
+    p.add_argument("mode", choices=("compact", "text"))
+    p.set_defaults(func=convert_storage)
+    p = subparsers.add_parser("compact", help=compact.__doc__)
+    p.add_argument("--keep", type=int, default=Cfg().reorg_window, help="number of recent blocks to keep for reorg detection")
+    p.set_defaults(func=compact)
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+    init_db()
+    if not args.func(args):
+        sys.exit(1)
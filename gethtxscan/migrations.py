@@ -0,0 +1,111 @@
+"""Versioned schema migrations, the current version is stored in the settings table."""
+
+from sqlalchemy import text
+import db_settings
+
+def rebuild_account_totals(session):
+    from models import AccountTotal
+    # the totals are computed from the current model, which reads the state column added by migration 4
+    add_transaction_state(session)
+    AccountTotal.rebuild(session)
+
+def create_indexes(session):
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_account_id ON transactions (account_id)"))
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_block_id ON transactions (block_id)"))
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_blocks_num ON blocks (num)"))
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_blocks_reorged_id ON blocks (reorged, id)"))
+    # gather stats so the planner knows reorged is not selective
+    session.execute(text("ANALYZE"))
+
+def record_storage_mode(session):
+    from models import Account
+    from config import Cfg
+    # new dbs use the configured storage mode, existing dbs were all written as text
+    mode = "text"
+    if session.query(Account).count() == 0:
+        mode = Cfg().storage_mode
+    db_settings.set_value(session, "storage_mode", mode, commit=False)
+
+def add_column(session, table, column, definition):
+    # new dbs already have the column from create_all
+    columns = [row[1] for row in session.execute(text("PRAGMA table_info(%s)" % table))]
+    if column not in columns:
+        session.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition)))
+
+def add_transaction_state(session):
+    add_column(session, "transactions", "state", "VARCHAR NOT NULL DEFAULT 'pending'")
+    session.execute(text("UPDATE transactions SET state = 'confirmed' WHERE block_id IS NOT NULL"))
+
+def add_block_parent_hash(session):
+    # existing blocks are left without one, reorgs are still found by comparing the block hashes
+    add_column(session, "blocks", "parent_hash", "BLOB")
+
+def add_tx_change_account_index(session):
+    session.execute(text('CREATE INDEX IF NOT EXISTS ix_tx_changes_to_seq ON tx_changes ("to", seq)'))
+
+# (version, description, function), in order
+MIGRATIONS = [
+    (1, "fill in account totals", rebuild_account_totals),
+    (2, "add transaction and block indexes", create_indexes),
+    (3, "record storage mode", record_storage_mode),
+    (4, "add transaction state", add_transaction_state),
+    (5, "add block parent hash", add_block_parent_hash),
+    (6, "add tx change account index", add_tx_change_account_index),
+]
+
+# columns converted by convert_storage: (table, key column, {column: kind})
+STORAGE_COLUMNS = [
+    ("accounts", "id", {"address": "address"}),
+    ("transactions", "id", {"from_": "address", "to": "address", "value": "uint256"}),
+    ("account_totals", "account_id", {"confirmed": "uint256", "pending": "uint256"}),
+    ("tx_changes", "seq", {"from_": "address", "to": "address", "value": "uint256"}),
+    ("backfills", "id", {"address": "address"}),
+]
+
+def convert_value(kind, value, compact):
+    from models import encode_address, decode_address, encode_uint256, decode_bigint
+    if value is None:
+        return None
+    if kind == "address":
+        value = decode_address(value)
+        return encode_address(value) if compact else value
+    value = decode_bigint(value)
+    return encode_uint256(value) if compact else str(value)
+
+def get_storage_mode(session):
+    return db_settings.get_value(session, "storage_mode", "text")
+
+def convert_storage(session, compact, batch_size=10000):
+    """Rewrite the address and value columns of an existing db in place (in one transaction)."""
+    for table, key, columns in STORAGE_COLUMNS:
+        names = ", ".join('"%s"' % column for column in columns)
+        update = text('UPDATE %s SET %s WHERE %s = :key' % (table, ", ".join('"%s" = :%s' % (column, column) for column in columns), key))
+        last = None
+        while True:
+            q = 'SELECT %s, %s FROM %s %s ORDER BY %s LIMIT %d' % (key, names, table, "WHERE %s > :last" % key if last is not None else "", key, batch_size)
+            rows = session.execute(text(q), {"last": last}).fetchall()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                values = {"key": row[0]}
+                for i, (column, kind) in enumerate(columns.items()):
+                    values[column] = convert_value(kind, row[i + 1], compact)
+                params.append(values)
+            session.execute(update, params)
+            last = rows[-1][0]
+    db_settings.set_value(session, "storage_mode", "compact" if compact else "text")
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def migrate(session, logger=None):
+    version = db_settings.get_schema_version(session)
+    for migration_version, description, fn in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        if logger:
+            logger.info("migrating db to version %d (%s)" % (migration_version, description))
+        fn(session)
+        # set_value commits so the migration and its version are saved together
+        db_settings.set_schema_version(session, migration_version)
@@ -1,12 +1,16 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Index
 import sqlalchemy.types as types
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import func
-from sqlalchemy import or_, and_, desc
+from sqlalchemy import or_, and_, desc, text, bindparam
 from marshmallow import Schema, fields, pre_dump
 import time
+import itertools
+from json.encoder import encode_basestring_ascii
 from database import Base
 from config import Cfg
+from utils import chunks
+from bloom import addresses_with_txs
 
 cfg = Cfg()
 
@@ -17,32 +21,100 @@ class TransactionSchema(Schema):
     value = fields.String()
     block_num = fields.Integer()
     date = fields.Integer()
+    state = fields.String()
 
     @pre_dump
     def hexify_txid(self, obj):
         obj.txid = "0x" + obj.txid.hex()
         return obj
 
+# when set addresses and values are written in their compact binary form (see set_compact_storage)
+compact_storage = False
+
+def set_compact_storage(compact):
+    global compact_storage
+    compact_storage = compact
+
+def encode_address(value):
+    # 20 byte blob for valid addresses, anything else is kept as text
+    if isinstance(value, str) and len(value) == 42 and value.startswith("0x"):
+        try:
+            return bytes.fromhex(value[2:])
+        except ValueError:
+            pass
+    return value
+
+def decode_address(value):
+    if isinstance(value, bytes):
+        return "0x" + value.hex()
+    return value
+
+def encode_uint256(value):
+    # fixed width big endian so blobs sort in numeric order
+    return int(value).to_bytes(32, "big", signed=True)
+
+def decode_bigint(value):
+    if isinstance(value, bytes):
+        return int.from_bytes(value, "big", signed=True)
+    return int(value)
+
 class BigInt(types.TypeDecorator):
-    """Convert ints to string in db and back to int on the way out."""
+    """Convert ints to string (or a 32 byte blob in compact mode) in db and back to int on the way out."""
 
     impl = types.String
 
     def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if compact_storage:
+            return encode_uint256(value)
         return str(value)
 
     def process_result_value(self, value, dialect):
-        return int(value)
+        if value is None:
+            return None
+        return decode_bigint(value)
+
+class Address(types.TypeDecorator):
+    """Hex address strings, stored as 20 byte blobs in compact mode."""
+
+    impl = types.String
+
+    def process_bind_param(self, value, dialect):
+        if compact_storage:
+            return encode_address(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        return decode_address(value)
+
+class Hash(types.TypeDecorator):
+    """Raw 32 byte hashes, always stored as blobs."""
+
+    impl = types.String
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return bytes(value)
+
+# transaction states, dropped txs left the pending pool without being mined
+TX_PENDING = "pending"
+TX_CONFIRMED = "confirmed"
+TX_DROPPED = "dropped"
+# only used in the change log, for txs removed because their block was reorged
+TX_REORGED = "reorged"
 
 class Transaction(Base):
     __tablename__ = 'transactions'
     id = Column(Integer, primary_key=True)
-    account_id = Column(Integer, ForeignKey('accounts.id'))
-    block_id = Column(Integer, ForeignKey('blocks.id'))
-    txid = Column(String, nullable=False, unique=True)
-    from_ = Column(String, nullable=False)
-    to = Column(String, nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), index=True)
+    block_id = Column(Integer, ForeignKey('blocks.id'), index=True)
+    txid = Column(Hash, nullable=False, unique=True)
+    from_ = Column(Address, nullable=False)
+    to = Column(Address, nullable=False)
     value = Column(BigInt)
+    state = Column(String, nullable=False, server_default=TX_PENDING)
 
     def __init__(self, account_id, block_id, txid, from_, to, value):
         self.account_id = account_id
@@ -51,11 +123,54 @@ class Transaction(Base):
         self.from_ = from_
         self.to = to
         self.value = value
+        self.state = TX_CONFIRMED if block_id else TX_PENDING
 
     @classmethod
     def from_txid(cls, session, txid):
         return session.query(cls).filter(cls.txid == txid).first()
 
+    @classmethod
+    def existing(cls, session, txids):
+        # map of txid -> row values for the txids that are already stored
+        result = {}
+        for txids in chunks(txids, 500):
+            q = session.query(cls.account_id, cls.block_id, cls.txid, cls.from_, cls.to, cls.value, cls.state).filter(cls.txid.in_(txids))
+            for row in q:
+                result[row.txid] = row._asdict()
+        return result
+
+    @classmethod
+    def pending_rows(cls, session):
+        # (txid, from, to, value) of the stored txs that are still pending
+        q = session.query(cls.txid, cls.from_, cls.to, cls.value).filter(cls.block_id == None).filter(cls.state == TX_PENDING)
+        return q.yield_per(10000)
+
+    @classmethod
+    def set_dropped(cls, session, txids):
+        # mark the stored pending txs that left the pool without being mined, returns the number marked
+        deltas = []
+        changes = []
+        for txids in chunks(txids, 500):
+            q = session.query(cls).filter(cls.txid.in_(txids)).filter(cls.block_id == None).filter(cls.state == TX_PENDING)
+            for tx in q:
+                tx.state = TX_DROPPED
+                deltas.append((tx.account_id, None, -tx.value))
+                changes.append(TxChange.snapshot(tx, TX_DROPPED))
+        AccountTotal.apply(session, deltas)
+        TxChange.record(session, changes)
+        return len(deltas)
+
+    @classmethod
+    def account_rows(cls, session, account_id, since_block=None, after_id=None):
+        # txs of an account joined with their block, as plain row tuples ordered by id
+        q = session.query(cls.id, cls.txid, cls.from_, cls.to, cls.value, cls.state, Block.num.label("block_num"), Block.date.label("block_date")) \
+            .outerjoin(Block, cls.block_id == Block.id).filter(cls.account_id == account_id)
+        if since_block is not None:
+            q = q.filter(or_(cls.block_id == None, Block.num >= since_block))
+        if after_id is not None:
+            q = q.filter(cls.id > after_id)
+        return q.order_by(cls.id)
+
     def __repr__(self):
         return '<Transaction %r>' % (self.txid)
 
@@ -66,6 +181,54 @@ class Transaction(Base):
         tx_schema = TransactionSchema()
         return tx_schema.dump(self).data
 
+upsert_txs = text("""INSERT INTO transactions (account_id, block_id, txid, from_, "to", value, state)
+    VALUES (:account_id, :block_id, :txid, :from_, :to, :value, :state)
+    ON CONFLICT(txid) DO UPDATE SET account_id = excluded.account_id, block_id = excluded.block_id,
+        from_ = excluded.from_, "to" = excluded."to", value = excluded.value, state = excluded.state""").bindparams(
+    bindparam("txid", type_=Hash), bindparam("from_", type_=Address), bindparam("to", type_=Address), bindparam("value", type_=BigInt))
+
+def tx_row_json(row):
+    # same output as TransactionSchema for a row from Transaction.account_rows
+    result = {"txid": "0x" + row.txid.hex(), "from_": row.from_, "to": row.to, "value": str(row.value), "state": row.state}
+    if row.block_num is not None:
+        result["block_num"] = row.block_num
+        result["date"] = int(row.block_date)
+    return result
+
+# tx_row_json dumped with sorted keys, for txs with and without a block
+TX_JSON = '{"block_num": %d, "date": %d, "from_": %s, "state": %s, "to": %s, "txid": "0x%s", "value": "%s"}'
+TX_JSON_PENDING = '{"from_": %s, "state": %s, "to": %s, "txid": "0x%s", "value": "%s"}'
+
+def json_string(value):
+    return "null" if value is None else encode_basestring_ascii(value)
+
+def tx_rows_json(rows, chunk_rows=1000):
+    """Yield the json list of the rows from Transaction.account_rows in chunks of chunk_rows txs.
+
+    The output is the same as joining json.dumps(tx_row_json(row), sort_keys=True)
+    but each row is formatted straight from its tuple, with the txids of a
+    chunk hex encoded together.
+    """
+    rows = iter(rows)
+    yield "["
+    sep = ""
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            break
+        # txids are always 32 bytes so each one is 64 hex chars of the joined hex
+        hexes = b"".join(row[1] for row in chunk).hex()
+        parts = []
+        for i, (_, _, from_, to, value, state, block_num, block_date) in enumerate(chunk):
+            txid = hexes[i * 64:i * 64 + 64]
+            if block_num is None:
+                parts.append(TX_JSON_PENDING % (json_string(from_), json_string(state), json_string(to), txid, value))
+            else:
+                parts.append(TX_JSON % (block_num, block_date, json_string(from_), json_string(state), json_string(to), txid, value))
+        yield sep + ",".join(parts)
+        sep = ","
+    yield "]\n"
+
 class AccountSchema(Schema):
     date = fields.Float()
     address = fields.String()
@@ -81,7 +244,7 @@ class Account(Base):
     __tablename__ = 'accounts'
     id = Column(Integer, primary_key=True)
     date = Column(Float, nullable=False, unique=False)
-    address = Column(String, nullable=False, unique=True)
+    address = Column(Address, nullable=False, unique=True)
     active = Column(Boolean, nullable=False, default=True)
     transactions = relationship('Transaction')
 
@@ -105,22 +268,38 @@ class Account(Base):
         return 0
 
     @classmethod
-    def has_txs(cls, session, addresses):
+    def has_txs(cls, session, addresses, tx_filter=None):
+        # addresses not in the filter of addresses with txs can be skipped without touching the db
+        if tx_filter is not None:
+            addresses = [address for address in addresses if address in tx_filter]
+        if len(addresses) > cfg.has_txs_temp_table_threshold:
+            return cls.has_txs_temp_table(session, addresses)
         result = []
-
         has_txs = cls.transactions.any()
-        q = session.query(cls, has_txs).filter(cls.address.in_(addresses))
-        for acct, has_txs in q.all():
-            if has_txs:
-                result.append(acct.address)
+        for addresses in chunks(addresses, 500):
+            q = session.query(cls.address).filter(cls.address.in_(addresses)).filter(has_txs)
+            for address, in q:
+                result.append(address)
         return result
 
-        #has_txs = cls.transactions.any()
-        #q = session.query(cls, has_txs)
-        #for acct, has_txs in q.all():
-        #    if has_txs and acct.address in addresses:
-        #        result.append(acct.address)
-        #return result
+    @classmethod
+    def has_txs_temp_table(cls, session, addresses):
+        # stage large address sets in a temp table and join on it instead of binding them all
+        session.execute(text("CREATE TEMP TABLE IF NOT EXISTS has_txs_addresses (address PRIMARY KEY)"))
+        session.execute(text("DELETE FROM has_txs_addresses"))
+        insert = text("INSERT OR IGNORE INTO has_txs_addresses (address) VALUES (:address)").bindparams(bindparam("address", type_=Address))
+        session.execute(insert, [{"address": address} for address in addresses])
+        # CROSS JOIN keeps the (small) staged table as the outer loop so accounts is only probed by its index
+        q = text("""SELECT accounts.address FROM has_txs_addresses CROSS JOIN accounts ON accounts.address = has_txs_addresses.address
+            WHERE EXISTS (SELECT 1 FROM transactions WHERE transactions.account_id = accounts.id)""").columns(address=Address)
+        result = [address for address, in session.execute(q)]
+        session.execute(text("DELETE FROM has_txs_addresses"))
+        return result
+
+    @classmethod
+    def addresses_with_txs(cls, session):
+        q = session.query(cls.address).filter(cls.transactions.any())
+        return (address for address, in q.yield_per(10000))
 
     @classmethod
     def all_addresses(cls, session):
@@ -131,24 +310,49 @@ class Account(Base):
         return simple_addr_list(session.query(cls).filter(cls.active == True).all())
 
     @classmethod
-    def add_txs(cls, session, address, block_id, txs):
-        acct = cls.from_address(session, address)
-        for tx in txs:
-            value = tx["value"]
-            from_ = tx["from"]
-            to = tx["to"]
-            if isinstance(value, str):
-                value = int(value, 16)
-            tx_ = Transaction.from_txid(session, tx["hash"])
-            if tx_:
-                tx_.account_id = acct.id
-                tx_.block_id = block_id
-                tx_.from_ = from_
-                tx_.to = to
-                tx_.value = value
-            else:
-                tx_ = Transaction(acct.id, block_id, tx["hash"], from_, to, value)
-            session.add(tx_)
+    def add_txs(cls, session, block_id, txs):
+        """Insert or update a batch of txs (a dict of address -> list of txs).
+
+        The existing rows for the batch are resolved with one query and all the
+        new or changed rows are then written with a single INSERT .. ON CONFLICT.
+        """
+        if not txs:
+            return []
+        accts = {}
+        for addresses in chunks(list(txs.keys()), 500):
+            for acct in session.query(cls).filter(cls.address.in_(addresses)):
+                accts[acct.address] = acct
+        for address in txs.keys():
+            if address not in accts:
+                accts[address] = Account(address)
+                session.add(accts[address])
+        session.flush()
+        rows = {}
+        for address, address_txs in txs.items():
+            for tx in address_txs:
+                value = tx["value"]
+                if isinstance(value, str):
+                    value = int(value, 16)
+                txid = bytes(tx["hash"])
+                rows[txid] = {"account_id": accts[address].id, "block_id": block_id, "txid": txid, "from_": tx["from"], "to": tx["to"], "value": value,
+                    "state": TX_CONFIRMED if block_id else TX_PENDING}
+        existing = Transaction.existing(session, list(rows.keys()))
+        changed = [row for txid, row in rows.items() if existing.get(txid) != row]
+        for address in txs.keys():
+            addresses_with_txs.add(address)
+        if changed:
+            session.execute(upsert_txs, changed)
+            block_num = session.query(Block.num).filter(Block.id == block_id).scalar() if block_id else None
+            TxChange.record(session, [TxChange.snapshot(row, row["state"], block_num) for row in changed])
+            # move the values of the changed txs between the account totals (dropped txs are not counted)
+            deltas = []
+            for row in changed:
+                old = existing.get(row["txid"])
+                if old and old["state"] != TX_DROPPED:
+                    deltas.append((old["account_id"], old["block_id"], -old["value"]))
+                deltas.append((row["account_id"], row["block_id"], row["value"]))
+            AccountTotal.apply(session, deltas)
+        return changed
 
     @classmethod
     def count(cls, session):
@@ -166,26 +370,61 @@ class Block(Base):
     __tablename__ = 'blocks'
     id = Column(Integer, primary_key=True)
     date = Column(Float, nullable=False, unique=False)
-    num = Column(Integer, nullable=False)
-    hash = Column(String, nullable=False, unique=True)
+    num = Column(Integer, nullable=False, index=True)
+    hash = Column(Hash, nullable=False, unique=True)
+    parent_hash = Column(Hash)
     reorged = Column(Boolean, nullable=False, default=False)
+    __table_args__ = (Index('ix_blocks_reorged_id', 'reorged', 'id'),)
     transactions = relationship('Transaction')
 
-    def __init__(self, block_num, block_hash):
+    def __init__(self, block_num, block_hash, parent_hash=None):
         self.date = time.time()
         self.num = block_num
         self.hash = block_hash
+        self.parent_hash = parent_hash
         self.reorged = False
 
-    def set_reorged(self, session):
-        for tx in self.transactions:
-            session.delete(tx)
-        self.reorged = True
-        session.add(self)
+    @classmethod
+    def rollback(cls, session, after_num):
+        """Mark every block above after_num as reorged and remove their txs, returns the number of blocks."""
+        blocks = session.query(cls).filter((cls.num > after_num) & (cls.reorged == False)).all()
+        block_nums = {block.id: block.num for block in blocks}
+        deltas = []
+        changes = []
+        for ids in chunks(list(block_nums.keys()), 500):
+            for tx in session.query(Transaction).filter(Transaction.block_id.in_(ids)):
+                deltas.append((tx.account_id, tx.block_id, -tx.value))
+                changes.append(TxChange.snapshot(tx, TX_REORGED, block_nums[tx.block_id]))
+                session.delete(tx)
+        for block in blocks:
+            block.reorged = True
+        AccountTotal.apply(session, deltas)
+        TxChange.record(session, changes)
+        session.flush()
+        return len(blocks)
+
+    @classmethod
+    def prune(cls, session, before_num, from_num=None):
+        """Delete the blocks below before_num that no transaction refers to, returns the number deleted."""
+        q = session.query(cls).filter(cls.num < before_num).filter(~cls.transactions.any())
+        if from_num is not None:
+            q = q.filter(cls.num >= from_num)
+        return q.delete(synchronize_session=False)
+
+    @classmethod
+    def range(cls, session, first_num, last_num):
+        # the blocks first_num..last_num we have stored (there can be gaps) as {num: block}
+        q = session.query(cls).filter((cls.num >= first_num) & (cls.num <= last_num) & (cls.reorged == False))
+        return {block.num: block for block in q}
+
+    @classmethod
+    def first_block_num(cls, session):
+        return session.query(func.min(cls.num)).filter(cls.reorged == False).scalar()
 
     @classmethod
     def last_block(cls, session):
-        return session.query(cls).filter(cls.reorged == False).order_by(cls.id.desc()).first()
+        # order by number, backfills can add old blocks after newer ones
+        return session.query(cls).filter(cls.reorged == False).order_by(cls.num.desc(), cls.id.desc()).first()
 
     @classmethod
     def from_number(cls, session, num):
@@ -213,6 +452,182 @@ class Block(Base):
     def __repr__(self):
         return '<Block %r %r>' % (self.num, self.hash)
 
+class AccountTotal(Base):
+    """Running total of the incoming value of an account (confirmed and pending kept separately)."""
+    __tablename__ = 'account_totals'
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)
+    confirmed = Column(BigInt, nullable=False)
+    pending = Column(BigInt, nullable=False)
+
+    def __init__(self, account_id, confirmed=0, pending=0):
+        self.account_id = account_id
+        self.confirmed = confirmed
+        self.pending = pending
+
+    @classmethod
+    def apply(cls, session, deltas):
+        # deltas is a list of (account_id, block_id, value) tuples, txs with a block_id are confirmed
+        if not deltas:
+            return
+        account_ids = list(set(account_id for account_id, _, _ in deltas))
+        totals = {}
+        for ids in chunks(account_ids, 500):
+            for total in session.query(cls).filter(cls.account_id.in_(ids)):
+                totals[total.account_id] = total
+        for account_id, block_id, value in deltas:
+            total = totals.get(account_id)
+            if not total:
+                total = totals[account_id] = cls(account_id)
+                session.add(total)
+            if block_id:
+                total.confirmed += value
+            else:
+                total.pending += value
+        session.flush()
+
+    @classmethod
+    def get(cls, session, account_id):
+        return session.query(cls).filter(cls.account_id == account_id).first()
+
+    @classmethod
+    def compute_all(cls, session):
+        # recompute the totals of every account from its transactions
+        totals = {}
+        q = session.query(Transaction.account_id, Transaction.block_id, Transaction.value, Transaction.state)
+        for account_id, block_id, value, state in q.yield_per(10000):
+            confirmed, pending = totals.get(account_id, (0, 0))
+            if block_id:
+                confirmed += value
+            elif state != TX_DROPPED:
+                pending += value
+            totals[account_id] = (confirmed, pending)
+        return totals
+
+    @classmethod
+    def rebuild(cls, session, totals=None):
+        if totals is None:
+            totals = cls.compute_all(session)
+        session.query(cls).delete()
+        for account_id, (confirmed, pending) in totals.items():
+            session.add(cls(account_id, confirmed, pending))
+
+    def __repr__(self):
+        return '<AccountTotal %r %r %r>' % (self.account_id, self.confirmed, self.pending)
+
+class BackfillSchema(Schema):
+    date = fields.Float()
+    address = fields.String()
+    from_block = fields.Integer()
+    to_block = fields.Integer()
+    next_block = fields.Integer()
+
+class Backfill(Base):
+    """A queued scan of the blocks from_block..to_block for the txs of a (newly watched) address."""
+    __tablename__ = 'backfills'
+    id = Column(Integer, primary_key=True)
+    date = Column(Float, nullable=False, unique=False)
+    address = Column(Address, nullable=False)
+    from_block = Column(Integer, nullable=False)
+    to_block = Column(Integer, nullable=False)
+    next_block = Column(Integer, nullable=False, index=True)
+
+    def __init__(self, address, from_block, to_block):
+        self.date = time.time()
+        self.address = address
+        self.from_block = from_block
+        self.to_block = to_block
+        self.next_block = from_block
+
+    @classmethod
+    def queue(cls, session, address, from_block, to_block):
+        backfill = cls(address, from_block, to_block)
+        session.add(backfill)
+        return backfill
+
+    @classmethod
+    def pending(cls, session):
+        return session.query(cls).filter(cls.next_block <= cls.to_block).order_by(cls.id).all()
+
+    @classmethod
+    def recent(cls, session, limit):
+        return session.query(cls).order_by(cls.id.desc()).limit(limit).all()
+
+    def done(self):
+        return self.next_block > self.to_block
+
+    def to_json(self):
+        backfill_schema = BackfillSchema()
+        result = backfill_schema.dump(self).data
+        result["done"] = self.done()
+        return result
+
+    def __repr__(self):
+        return '<Backfill %r %r-%r>' % (self.address, self.from_block, self.to_block)
+
+class TxChangeSchema(Schema):
+    seq = fields.Integer()
+    date = fields.Float()
+    txid = fields.Method("hex_txid")
+    from_ = fields.String()
+    to = fields.String()
+    value = fields.String()
+    state = fields.String()
+    block_num = fields.Integer()
+
+    def hex_txid(self, obj):
+        return "0x" + obj.txid.hex()
+
+class TxChange(Base):
+    """Change log of the transactions, a snapshot of a tx whenever it is added, changes state or is reorged out."""
+    __tablename__ = 'tx_changes'
+    # autoincrement so a seq is never reused
+    __table_args__ = (Index('ix_tx_changes_to_seq', 'to', 'seq'), {'sqlite_autoincrement': True})
+    seq = Column(Integer, primary_key=True)
+    date = Column(Float, nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
+    txid = Column(Hash, nullable=False)
+    from_ = Column(Address, nullable=False)
+    to = Column(Address, nullable=False)
+    value = Column(BigInt)
+    state = Column(String, nullable=False)
+    block_num = Column(Integer)
+
+    @classmethod
+    def snapshot(cls, tx, state, block_num=None):
+        # tx is a Transaction or a row dict from Account.add_txs
+        if isinstance(tx, dict):
+            return {"account_id": tx["account_id"], "txid": tx["txid"], "from_": tx["from_"], "to": tx["to"], "value": tx["value"], "state": state, "block_num": block_num}
+        return {"account_id": tx.account_id, "txid": tx.txid, "from_": tx.from_, "to": tx.to, "value": tx.value, "state": state, "block_num": block_num}
+
+    @classmethod
+    def record(cls, session, changes):
+        if not changes:
+            return
+        now = time.time()
+        for change in changes:
+            change["date"] = now
+        session.execute(cls.__table__.insert(), changes)
+
+    @classmethod
+    def since(cls, session, seq, limit):
+        return session.query(cls).filter(cls.seq > seq).order_by(cls.seq).limit(limit).all()
+
+    @classmethod
+    def last_seq(cls, session):
+        return session.query(func.max(cls.seq)).scalar() or 0
+
+    @classmethod
+    def last_account_seq(cls, session, address):
+        # the seq of the last change to the txs of an account, 0 if there were none
+        return session.query(func.max(cls.seq)).filter(cls.to == address).scalar() or 0
+
+    def to_json(self):
+        change_schema = TxChangeSchema()
+        return change_schema.dump(self).data
+
+    def __repr__(self):
+        return '<TxChange %r %r %r>' % (self.seq, self.txid, self.state)
+
 class Setting(Base):
     __tablename__ = 'settings'
     id = Column(Integer, primary_key=True)
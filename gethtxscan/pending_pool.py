@@ -0,0 +1,107 @@
+import time
+import collections
+
+class PendingPool():
+    """Pool of pending txs indexed by recipient and by the time they were seen.
+
+    Txs are matched against the watched addresses (`is_watched`) when they are
+    added, and again for a single address in `watch`, so `matches` only walks
+    the txs of watched recipients. Expiry pops from the front of a time
+    ordered queue, entries of txs that were removed in the meantime are
+    skipped there (and compacted away if they pile up). The pool holds at most
+    `max_size` txs, the oldest are evicted to make room.
+
+    Txs that have been written to the db are tracked in `persisted`, when one
+    of them expires or is evicted (rather than being mined) its txid is kept
+    in `dropped` until the db has been updated.
+    """
+
+    def __init__(self, max_size, is_watched):
+        self.max_size = max_size
+        self.is_watched = is_watched
+        self.txs = {}
+        self.by_to = {}
+        self.watched = {}
+        self.expiry = collections.deque()
+        self.evicted = 0
+        self.persisted = set()
+        self.dropped = []
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txid):
+        return txid in self.txs
+
+    def add(self, txid, timestamp, tx):
+        if txid in self.txs:
+            return
+        while len(self.txs) >= self.max_size:
+            self.pop_oldest()
+            self.evicted += 1
+        self.txs[txid] = (timestamp, tx)
+        self.expiry.append((timestamp, txid))
+        to = tx["to"]
+        self.by_to.setdefault(to, {})[txid] = None
+        if self.is_watched(to):
+            self.watched.setdefault(to, {})[txid] = None
+
+    def remove(self, txid, dropped=False):
+        item = self.txs.pop(txid, None)
+        if not item:
+            return False
+        if txid in self.persisted:
+            self.persisted.remove(txid)
+            if dropped:
+                self.dropped.append(txid)
+        to = item[1]["to"]
+        for index in (self.by_to, self.watched):
+            txids = index.get(to)
+            if txids is not None:
+                txids.pop(txid, None)
+                if not txids:
+                    del index[to]
+        if len(self.expiry) > 2 * len(self.txs) + 1000:
+            # the txs dict is in insertion (time) order so the queue can be rebuilt from it
+            self.expiry = collections.deque((timestamp, txid) for txid, (timestamp, tx) in self.txs.items())
+        return True
+
+    def pop_oldest(self):
+        while self.expiry:
+            timestamp, txid = self.expiry.popleft()
+            if self.remove(txid, dropped=True):
+                return txid
+
+    def expire(self, max_age, now=None):
+        now = now or time.time()
+        count = 0
+        while self.expiry and now - self.expiry[0][0] > max_age:
+            timestamp, txid = self.expiry.popleft()
+            if self.remove(txid, dropped=True):
+                count += 1
+        return count
+
+    def watch(self, address):
+        txids = self.by_to.get(address)
+        if txids:
+            self.watched[address] = dict(txids)
+
+    def unwatch(self, address):
+        self.watched.pop(address, None)
+
+    def matches(self, unpersisted=False):
+        # txs of the watched recipients as {address: [tx, ..]}, optionally only the ones not written to the db yet
+        result = {}
+        for to, txids in self.watched.items():
+            txs = [self.txs[txid][1] for txid in txids if not (unpersisted and txid in self.persisted)]
+            if txs:
+                result[to] = txs
+        return result
+
+    def set_persisted(self, txids):
+        self.persisted.update(txid for txid in txids if txid in self.txs)
+
+    def take_dropped(self):
+        dropped = self.dropped
+        self.dropped = []
+        return dropped
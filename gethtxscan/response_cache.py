@@ -0,0 +1,64 @@
+import collections
+from config import Cfg
+
+class ResponseCache():
+    """In-process cache of read endpoint responses with the etags to go with them.
+
+    Responses are kept under the key they depend on: an account address,
+    versioned by the last change log seq of the account, or a global key
+    (like "last_blocknum") versioned by the db value it is built from (like the
+    scan cursor). The versions come from the db so every api worker gives the
+    same etag to the same response. The writers invalidate a key when they
+    commit a change to it, which sets its version and drops its responses.
+    Accounts are kept in an LRU of at most max_accounts.
+    """
+
+    def __init__(self, max_accounts=10000):
+        self.max_accounts = max_accounts
+        self.accounts = collections.OrderedDict()
+        self.globals = {}
+
+    def account_etag(self, address, load_seq):
+        entry = self.accounts.get(address)
+        if entry is None:
+            entry = self.accounts[address] = [load_seq(), {}]
+            while len(self.accounts) > self.max_accounts:
+                self.accounts.popitem(last=False)
+        else:
+            self.accounts.move_to_end(address)
+        return "a%d" % entry[0]
+
+    def global_etag(self, name, load_version):
+        entry = self.globals.get(name)
+        if entry is None:
+            entry = self.globals[name] = [load_version(), {}]
+        return "g%d" % entry[0]
+
+    def _entry(self, key):
+        return self.accounts.get(key) or self.globals.get(key)
+
+    def get(self, key, request_key):
+        entry = self._entry(key)
+        if entry:
+            return entry[1].get(request_key)
+
+    def put(self, key, request_key, response):
+        entry = self._entry(key)
+        if entry:
+            entry[1][request_key] = response
+
+    def invalidate_account(self, address, seq):
+        # accounts that are not cached will load their (new) seq when they are next requested
+        entry = self.accounts.get(address)
+        if entry:
+            entry[0] = max(entry[0], seq)
+            entry[1] = {}
+
+    def invalidate(self, name, version):
+        # a global version can go down (the scan cursor after a reorg) so it is replaced, not maxed
+        entry = self.globals.get(name)
+        if entry and entry[0] != version:
+            entry[0] = version
+            entry[1] = {}
+
+response_cache = ResponseCache(Cfg().response_cache_accounts)
@@ -0,0 +1,61 @@
+import time
+import logging
+import requests
+from utils import chunks
+
+logger = logging.getLogger(__name__)
+
+class RpcError(Exception):
+    pass
+
+class BatchRpc():
+    """JSON-RPC client that sends many calls in one POST over a keep-alive session."""
+
+    def __init__(self, uri, timeout=60):
+        self.uri = uri
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.request_id = 0
+        self.stats = {"batches": 0, "calls": 0, "seconds": 0.0, "last_calls": 0, "last_seconds": 0.0}
+
+    def batch(self, calls):
+        """Send a list of (method, params) calls as one batch, results are returned in call order."""
+        if not calls:
+            return []
+        reqs = []
+        for method, params in calls:
+            self.request_id += 1
+            reqs.append({"jsonrpc": "2.0", "id": self.request_id, "method": method, "params": params})
+        start = time.time()
+        r = self.session.post(self.uri, json=reqs, timeout=self.timeout)
+        r.raise_for_status()
+        responses = r.json()
+        elapsed = time.time() - start
+        self.stats["batches"] += 1
+        self.stats["calls"] += len(reqs)
+        self.stats["seconds"] += elapsed
+        self.stats["last_calls"] = len(reqs)
+        self.stats["last_seconds"] = elapsed
+        logger.info("rpc batch of %d calls (%s) took %f seconds" % (len(reqs), reqs[0]["method"], elapsed))
+        # the whole batch can be rejected with a single error object
+        if isinstance(responses, dict):
+            raise RpcError("rpc batch failed: %s" % responses.get("error"))
+        responses = {resp["id"]: resp for resp in responses}
+        results = []
+        for req in reqs:
+            resp = responses.get(req["id"])
+            if not resp:
+                raise RpcError("no response for %s %s" % (req["method"], req["params"]))
+            if "error" in resp:
+                raise RpcError("%s %s failed: %s" % (req["method"], req["params"], resp["error"]))
+            results.append(resp["result"])
+        return results
+
+    def batch_chunked(self, calls, size):
+        results = []
+        for chunk in chunks(calls, size):
+            results += self.batch(chunk)
+        return results
+
+    def call(self, method, *params):
+        return self.batch([(method, list(params))])[0]
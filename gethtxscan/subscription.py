@@ -0,0 +1,139 @@
+import json
+import codecs
+import socket
+import gevent
+import websocket
+from gevent import Greenlet
+from gevent.event import Event
+from hexbytes import HexBytes
+
+class WebsocketTransport():
+    def __init__(self, uri, timeout):
+        self.ws = websocket.create_connection(uri, timeout=timeout)
+
+    def send(self, msg):
+        self.ws.send(json.dumps(msg))
+
+    def recv(self):
+        return json.loads(self.ws.recv())
+
+    def close(self):
+        self.ws.close()
+
+class IpcTransport():
+    # geth ipc is a plain stream of json objects without any framing
+    def __init__(self, path, timeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.buf = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+
+    def send(self, msg):
+        self.sock.sendall(json.dumps(msg).encode())
+
+    def recv(self):
+        while True:
+            self.buf = self.buf.lstrip()
+            if self.buf:
+                try:
+                    msg, end = self.decoder.raw_decode(self.buf)
+                    self.buf = self.buf[end:]
+                    return msg
+                except ValueError:
+                    # incomplete object, read some more
+                    pass
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("ipc connection closed")
+            self.buf += self.utf8.decode(data)
+
+    def close(self):
+        self.sock.close()
+
+def connect(uri, timeout):
+    if uri.startswith("ws://") or uri.startswith("wss://"):
+        return WebsocketTransport(uri, timeout)
+    return IpcTransport(uri, timeout)
+
+class SubscriptionGreenlet(Greenlet):
+    """Subscribes to geth newHeads and newPendingTransactions over a websocket or ipc connection.
+
+    Events are collected for the consumer (BlockCheckGreenlet) which is woken
+    through `wakeup`. While the subscription is down `connected` is False so
+    the consumer can fall back to polling, reconnecting is retried every
+    `retry_delay` seconds.
+    """
+
+    def __init__(self, logger, uri, timeout=60):
+        Greenlet.__init__(self)
+        self.logger = logger
+        self.uri = uri
+        self.timeout = timeout
+        self.retry_delay = 10
+        self.keep_running = True
+        self.connected = False
+        self.wakeup = Event()
+        self.new_heads = 0
+        self.pending_txids = []
+        self.subscriptions = {}
+
+    def stop_processing(self):
+        self.keep_running = False
+
+    def take_events(self):
+        # return (number of new heads, pending txids) seen since the last call
+        new_heads, pending_txids = self.new_heads, self.pending_txids
+        self.new_heads = 0
+        self.pending_txids = []
+        self.wakeup.clear()
+        return new_heads, pending_txids
+
+    def _run(self):
+        while self.keep_running:
+            transport = None
+            try:
+                transport = connect(self.uri, self.timeout)
+                self.subscribe(transport)
+                self.connected = True
+                self.logger.info("subscribed to new heads and pending txs on %s" % self.uri)
+                # wake the consumer in case anything happened while we were not subscribed
+                self.wakeup.set()
+                while self.keep_running:
+                    self.handle(transport.recv())
+            except Exception as e:
+                self.logger.error("subscription to %s failed (%s), falling back to polling" % (self.uri, e))
+            finally:
+                if transport:
+                    transport.close()
+                if self.connected:
+                    self.connected = False
+                    self.wakeup.set()
+            gevent.sleep(self.retry_delay)
+
+    def subscribe(self, transport):
+        self.subscriptions = {}
+        kinds = {1: "newHeads", 2: "newPendingTransactions"}
+        for request_id, kind in kinds.items():
+            transport.send({"jsonrpc": "2.0", "id": request_id, "method": "eth_subscribe", "params": [kind]})
+        while len(self.subscriptions) < len(kinds):
+            msg = transport.recv()
+            if msg.get("id") in kinds:
+                if "error" in msg:
+                    raise Exception("eth_subscribe %s failed: %s" % (kinds[msg["id"]], msg["error"]))
+                self.subscriptions[msg["result"]] = kinds[msg["id"]]
+            else:
+                self.handle(msg)
+
+    def handle(self, msg):
+        if msg.get("method") != "eth_subscription":
+            return
+        params = msg["params"]
+        kind = self.subscriptions.get(params["subscription"])
+        if kind == "newHeads":
+            self.new_heads += 1
+            self.wakeup.set()
+        elif kind == "newPendingTransactions":
+            self.pending_txids.append(HexBytes(params["result"]))
+            self.wakeup.set()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""Reorg handling of the block scanner against a fake chain, run with: python3 -m unittest test_reorgs"""
+
+import hashlib
+import logging
+import tempfile
+import unittest
+import gevent.lock
+import database
+import db_settings
+import eth_blocks
+import block_check
+from models import Account, AccountTotal, Block, Transaction
+from address_index import active_addresses
+from change_hub import change_hub
+from bench import use_scratch_app_db, random_address
+
+class FakeChainRpc():
+    """Stands in for BatchRpc, serves the blocks of an in-memory chain that can be forked."""
+
+    def __init__(self):
+        self.blocks = []
+        self.stats = {"batches": 0, "calls": 0}
+
+    def build(self, length, to, fork_from=None, salt=""):
+        # blocks from fork_from on are replaced with blocks of a different hash (and txs), every third block pays `to`
+        fork_from = len(self.blocks) if fork_from is None else fork_from
+        self.blocks = self.blocks[:fork_from]
+        for num in range(fork_from, length):
+            parent = self.blocks[-1]["hash"] if self.blocks else "0x" + "00" * 32
+            block_hash = "0x" + hashlib.sha256(("block %d %s" % (num, salt)).encode()).hexdigest()
+            txs = []
+            if num % 3 == 0:
+                txid = "0x" + hashlib.sha256(("tx %d %s" % (num, salt)).encode()).hexdigest()
+                txs.append({"hash": txid, "from": "0x" + "11" * 20, "to": to, "value": hex(num + len(salt))})
+            self.blocks.append({"hash": block_hash, "parentHash": parent, "transactions": txs})
+
+    def expected(self):
+        # (txids, value total) of the txs of the chain
+        txs = [tx for block in self.blocks for tx in block["transactions"]]
+        return set(tx["hash"] for tx in txs), sum(int(tx["value"], 16) for tx in txs)
+
+    def batch(self, calls):
+        self.stats["batches"] += 1
+        self.stats["calls"] += len(calls)
+        results = []
+        for method, params in calls:
+            if method == "eth_blockNumber":
+                results.append(hex(len(self.blocks) - 1))
+            elif method == "eth_getBlockByNumber":
+                num = int(params[0], 16)
+                results.append(self.blocks[num] if num < len(self.blocks) else None)
+            else:
+                raise Exception("unexpected rpc call %s" % method)
+        return results
+
+    def batch_chunked(self, calls, size):
+        return self.batch(calls)
+
+    def call(self, method, *params):
+        return self.batch([(method, list(params))])[0]
+
+class ReorgTest(unittest.TestCase):
+    length = 300
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        use_scratch_app_db(self.dir.name)
+        database.init_db()
+        self.session = database.db_session
+        self.address = random_address()
+        self.session.add(Account(self.address))
+        db_settings.set_current_block_number(self.session, -1)
+        active_addresses.add(self.address)
+        change_hub.start(0)
+        self.rpc, self.block_store, self.sparse_blocks = eth_blocks.rpc, eth_blocks.block_store, block_check.cfg.sparse_blocks
+        self.chain = eth_blocks.rpc = FakeChainRpc()
+        # every block comes from the fake chain and is kept (the checks compare all the stored blocks)
+        eth_blocks.block_store = None
+        block_check.cfg.sparse_blocks = False
+
+    def tearDown(self):
+        eth_blocks.rpc, eth_blocks.block_store, block_check.cfg.sparse_blocks = self.rpc, self.block_store, self.sparse_blocks
+        active_addresses.remove(self.address)
+        self.session.remove()
+        self.dir.cleanup()
+
+    def scan_fork(self, depth):
+        # scan the chain, then fork it `depth` blocks deep (growing it by one block) and scan again
+        self.chain.build(self.length, self.address)
+        scanner = block_check.BlockCheckGreenlet(logging.getLogger("test"), gevent.lock.RLock())
+        scanner.block_check()
+        self.chain.build(self.length + 1, self.address, self.length - depth, "fork")
+        scanner.block_check()
+        acct = Account.from_address(self.session, self.address)
+        expected_txids, expected_total = self.chain.expected()
+        self.assertEqual(db_settings.get_current_block_number(self.session, None), self.length)
+        # the stored blocks that are not marked reorged are exactly the chain
+        blocks = self.session.query(Block).filter(Block.reorged == False).order_by(Block.num)
+        self.assertEqual(["0x" + block.hash.hex() for block in blocks], [block["hash"] for block in self.chain.blocks])
+        self.assertEqual(set("0x" + row.txid.hex() for row in Transaction.account_rows(self.session, acct.id)), expected_txids)
+        self.assertEqual(AccountTotal.get(self.session, acct.id).confirmed, expected_total)
+        self.assertEqual(AccountTotal.compute_all(self.session)[acct.id], (expected_total, 0))
+
+    def test_fork_depth_1(self):
+        self.scan_fork(1)
+
+    def test_fork_depth_10(self):
+        self.scan_fork(10)
+
+    def test_fork_depth_100(self):
+        self.scan_fork(100)
+
+if __name__ == "__main__":
+    unittest.main()